@@ -0,0 +1,181 @@
+#!/usr/bin/env python2
+'''
+Benchmark of ?city lookups against a GeoNames cities database.
+
+Given the database built by plugins/cities_db_2_sqlite.py (--db),
+times ?city for random cities in it and prints the query plan,
+leaving the database untouched.  Without --db, a synthetic table
+of --rows cities is built and timed before and after creating the
+indexes CitiesDB expects, e.g.:
+
+  python2 benchmarks/citybench.py --db plugins/cities.db
+  python2 benchmarks/citybench.py --rows 1000000
+'''
+# Imports
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+
+# The bot's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from botstats import Metric
+from plugins.Lookup import CitiesDB, Lookup
+
+# Constants
+CITIES_SQL = '''CREATE TABLE cities (
+    gid INTEGER NOT NULL UNIQUE, name TEXT, asciiname TEXT,
+    alternate_names TEXT, latitude REAL, longitude REAL,
+    feature_class TEXT, feature_code TEXT, iso TEXT, cc2 TEXT,
+    admin1_code TEXT, admin2_code TEXT, admin3_code TEXT,
+    admin4_code TEXT, population INTEGER, elevation INTEGER,
+    dem INTEGER, timezone TEXT, updated TEXT
+)'''
+COUNTRIES = ['US', 'FR', 'DE', 'GB', 'IN', 'BR', 'CN', 'RU', 'JP', 'MX']
+
+def synthetic_db(fname, rows, rng):
+  '''
+  Write a cities table of rows cities,
+  about ten per name, to fname.
+  '''
+  word = lambda: ''.join(rng.choice(string.ascii_lowercase) \
+                            for _ in range(rng.randint(4, 10))).title()
+  names = [word() for _ in range(max(1, rows / 10))]
+
+  con = sqlite3.connect(fname)
+  with con:
+    con.execute(CITIES_SQL)
+    con.executemany(
+        'INSERT INTO cities (gid, name, asciiname, latitude, longitude, iso, '
+        'population, timezone) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        ((i, name, name, rng.uniform(-90, 90), rng.uniform(-180, 180),
+          rng.choice(COUNTRIES), rng.choice([0, rng.randint(1, 10 ** 7)]),
+          'Etc/UTC') \
+            for i, name in ((i, rng.choice(names)) for i in xrange(rows))))
+  con.close()
+
+def sample(fname, n, rng):
+  '''
+  Return a list of n (asciiname, iso)
+  2-tuples of populated cities in fname.
+  '''
+  con = sqlite3.connect(fname)
+  count = con.execute('SELECT MAX(rowid) FROM cities').fetchone()[0] or 0
+  cities = []
+  for _ in range(n * 20):
+    if len(cities) >= n:
+      break
+    row = con.execute('SELECT asciiname, iso FROM cities WHERE rowid = ? '
+                      'AND population > 0', (rng.randint(1, count),)).fetchone()
+    if row and row[0]:
+      cities.append((row[0].encode('utf-8'), row[1]))
+  con.close()
+  return cities
+
+def lookup(fname, limit):
+  '''
+  Return a Lookup answering ?city from
+  fname, without any of its other data.
+  '''
+  lu = Lookup.__new__(Lookup)
+  lu.cdb = CitiesDB(fname, 'cities', cache_size=0)
+  lu.cities_select_limit = limit
+  lu.build_city_parser()
+  return lu
+
+def plan(cdb, with_iso):
+  '''
+  Return the query plan of a ?city query.
+  '''
+  sql = 'EXPLAIN QUERY PLAN ' + \
+        cdb.exact_sql(1, 5, ('iso', 'population', 'timezone'), with_iso)
+  args = {'n0': 'Paris', 'iso': 'FR'}
+  return ' / '.join(str(row[-1]) for row in cdb.con.execute(sql, args))
+
+def run(lu, cities, queries, rng):
+  '''
+  Time queries ?city lookups of random
+  cities, about half of them with a
+  country code, and return a dictionary of their
+  latency summaries.
+  '''
+  metrics = {'city': Metric(samples=None), 'city_cc': Metric(samples=None)}
+  for _ in range(queries):
+    name, iso = rng.choice(cities)
+    with_iso = rng.random() < 0.5 and iso
+    msg = '?city "{}"'.format(name) + \
+          (' --country-code {}'.format(iso) if with_iso else '')
+
+    start = time.time()
+    lu.city(msg)
+    metrics['city_cc' if with_iso else 'city'].record(time.time() - start)
+
+  results = dict((k, m.summary()) for k, m in metrics.items())
+  results['plan'] = plan(lu.cdb, False)
+  results['plan_cc'] = plan(lu.cdb, True)
+  return results
+
+def report(label, results):
+  print '[{}]'.format(label)
+  for name, label in (('city', '?city'), ('city_cc', '?city --country-code')):
+    s = results[name]
+    print '  {:<22} n={} mean={}ms p50={}ms p95={}ms p99={}ms'.format(
+            label, s['count'], s['mean'], s['p50'], s['p95'], s['p99'])
+  for name, label in (('plan', '?city'), ('plan_cc', '?city --country-code')):
+    print '  {:<22} plan: {}'.format(label, results[name])
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='gilbertgrapesmom ?city benchmark')
+  parser.add_argument('--db', help='cities database built by cities_db_2_sqlite.py')
+  parser.add_argument('--rows', type=int, default=500000,
+                      help='Cities in the synthetic database (without --db)')
+  parser.add_argument('--queries', type=int, default=200)
+  parser.add_argument('--limit', type=int, default=5,
+                      help='Like cities_select_limit')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output', help='Also write the results to this JSON file')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  rng = random.Random(args.seed)
+  results = {}
+
+  if args.db:
+    cities = sample(args.db, 100, rng)
+    results['db'] = run(lookup(args.db, args.limit), cities, args.queries, rng)
+    report(args.db, results['db'])
+  else:
+    tmp = tempfile.mkdtemp(prefix='ggm-citybench-')
+    try:
+      fname = os.path.join(tmp, 'cities.db')
+      start = time.time()
+      synthetic_db(fname, args.rows, rng)
+      print 'Built {} cities in {:.1f}s'.format(args.rows, time.time() - start)
+      cities = sample(fname, 100, rng)
+
+      lu = lookup(fname, args.limit)
+      results['unindexed'] = run(lu, cities, args.queries, rng)
+      report('unindexed', results['unindexed'])
+
+      start = time.time()
+      lu.cdb.create_indexes()
+      print 'Indexed in {:.1f}s'.format(time.time() - start)
+      results['indexed'] = run(lu, cities, args.queries, rng)
+      report('indexed', results['indexed'])
+    finally:
+      shutil.rmtree(tmp, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,473 @@
+#!/usr/bin/env python2
+'''
+End-to-end load benchmark for gilbertgrapesmom.
+
+Starts a GilbertGrapesMomFactory against a local stand-in IRC
+server, which answers CAP/SASL and JOINs and then fires PRIVMSG
+traffic at the bot, while every upstream API the plugins use is
+answered by a local HTTP stub with a configurable latency.
+
+Reports end-to-end reply latency percentiles and the sustained
+message and reply rates.
+
+Run from the top of the repository, e.g.:
+
+  python2 benchmarks/loadbench.py --rate 200 --channels 5 --duration 30
+'''
+# Imports
+import argparse
+import BaseHTTPServer
+from collections import deque
+import json
+import os
+import random
+import shutil
+import SocketServer
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.protocols import basic
+
+# The bot's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gilbertgrapesmom
+from botstats import Metric
+from httpclient import HTTPClient
+from plugins.Lookup import CitiesDB
+
+# Constants
+CHATTER = [ 'anyone around?'
+          , 'that build is still broken for me'
+          , 'lol'
+          , 'brb, getting coffee'
+          , 'did you see the game last night'
+          ]
+COMMANDS = [ '?avg'
+           , '?avg -c EUR'
+           , '?rate ltc btc'
+           , '?forex USD EUR'
+           , '?areacode 212 415'
+           , '?city Paris'
+           , '?geoip 8.8.8.8'
+           , '?commands'
+           ]
+CURRENCIES_CSV = '''Entity,Currency,AlphabeticCode
+UNITED STATES,US Dollar,USD
+EUROPEAN UNION,Euro,EUR
+UNITED KINGDOM,Pound Sterling,GBP
+'''
+CITIES_SQL = '''CREATE TABLE cities (
+    gid INTEGER NOT NULL UNIQUE, name TEXT, asciiname TEXT,
+    alternate_names TEXT, latitude REAL, longitude REAL,
+    feature_class TEXT, feature_code TEXT, iso TEXT, cc2 TEXT,
+    admin1_code TEXT, admin2_code TEXT, admin3_code TEXT,
+    admin4_code TEXT, population INTEGER, elevation INTEGER,
+    dem INTEGER, timezone TEXT, updated TEXT
+)'''
+
+#------------------------------------------------------------#
+#                                                            #
+#                      UPSTREAM STUBS                        #
+#                                                            #
+#------------------------------------------------------------#
+def exchange(price, volume):
+  return { 'volume_btc': volume
+         , 'rates': {'ask': price + 1, 'bid': price - 1, 'last': price}
+         }
+
+UPSTREAMS = {
+  '/api.bitcoinaverage.com/exchanges/all':
+      { 'USD': { 'bitstamp': exchange(600.0, 9000.0)
+               , 'btce': exchange(590.0, 7000.0)
+               , 'bitfinex': exchange(605.0, 12000.0)
+               }
+      , 'EUR': { 'kraken': exchange(440.0, 3000.0)
+               , 'bitcurex': exchange(445.0, 500.0)
+               }
+      , 'timestamp': 'Sat, 01 Mar 2014 00:00:00 -0000'
+      },
+  '/api.bitcoinaverage.com/ignored':
+      {'mtgox': 'withdrawals halted'},
+  '/www.cryptocoincharts.info/v2/api/listCoins':
+      [ {'id': 'btc', 'name': 'Bitcoin', 'volume_btc': '100000'}
+      , {'id': 'ltc', 'name': 'Litecoin', 'volume_btc': '4000'}
+      , {'id': 'doge', 'name': 'Dogecoin', 'volume_btc': '900'}
+      ],
+  '/openexchangerates.org/api/latest.json':
+      {'base': 'USD', 'rates': {'USD': 1.0, 'EUR': 0.72, 'GBP': 0.6}},
+  '/openexchangerates.org/api/currencies.json':
+      {'USD': 'US Dollar', 'EUR': 'Euro', 'GBP': 'Pound Sterling'},
+  '/api.icndb.com/jokes/random/':
+      {'value': {'joke': 'Chuck Norris counted to infinity. Twice.'}},
+}
+
+class UpstreamStub(BaseHTTPServer.BaseHTTPRequestHandler):
+  '''
+  Answers every upstream API used by the
+  plugins after latency seconds.
+
+  Runs in its own threads, off the reactor,
+  as plugins pull data while they are being
+  constructed on the reactor thread.
+  '''
+  protocol_version = 'HTTP/1.1'   # Keep-alive like the real APIs
+  latency = 0.0
+
+  def payload(self, path):
+    if path in UPSTREAMS:
+      return UPSTREAMS[path]
+    elif '/tradingPair/' in path:
+      pair = path.rsplit('/', 1)[-1].replace('_', '/')
+      return {'id': pair, 'price': '0.0251', 'best_market': 'btc-e'}
+    elif path.startswith('/freegeoip.net/json/'):
+      return { 'ip': path.rsplit('/', 1)[-1]
+             , 'city': 'Mountain View'
+             , 'country_code': 'US'
+             }
+
+  def reply(self):
+    # Drain any request body
+    length = int(self.headers.get('Content-Length') or 0)
+    if length:
+      self.rfile.read(length)
+
+    time.sleep(self.latency)
+    body = self.payload(urlparse.urlparse(self.path).path)
+    body = json.dumps(body) if body is not None else ''
+    self.send_response(200 if body else 404)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+  do_GET = do_POST = do_HEAD = reply
+
+  def log_message(self, *args):
+    pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    # Keep-alive connections dropped at exit
+    pass
+
+class StubHTTPClient(HTTPClient):
+  '''
+  HTTPClient sending every request to
+  the local upstream stub instead.
+  '''
+  stub = None
+
+  def request(self, method, url, **kwargs):
+    parsed = urlparse.urlparse(url)
+    url = '{}/{}{}'.format(self.stub, parsed.netloc, parsed.path)
+    return HTTPClient.request(self, method, url, **kwargs)
+
+#------------------------------------------------------------#
+#                                                            #
+#                     FAKE IRC SERVER                        #
+#                                                            #
+#------------------------------------------------------------#
+class FakeIRCServer(basic.LineOnlyReceiver):
+  '''
+  Minimal IRC server speaking just enough
+  of the protocol to sign the bot on and
+  feed it traffic.
+  '''
+  delimiter = '\r\n'
+  MAX_LENGTH = 65536
+
+  def connectionMade(self):
+    self.nick = None
+    self.joined = set()
+    self.bench = self.factory.bench
+
+  def send(self, line):
+    self.sendLine(line)
+
+  def lineReceived(self, line):
+    cmnd, _, rest = line.partition(' ')
+    handler = getattr(self, 'irc_' + cmnd.upper(), None)
+    if handler:
+      handler(rest)
+
+  def irc_NICK(self, rest):
+    self.nick = rest.strip()
+
+  def irc_USER(self, rest):
+    self.send(':fake.server 001 {} :Welcome to the benchmark'.format(self.nick))
+
+  def irc_CAP(self, rest):
+    if rest.startswith('REQ'):
+      self.send(':fake.server CAP {} ACK :sasl'.format(self.nick))
+
+  def irc_AUTHENTICATE(self, rest):
+    if rest.strip() != 'PLAIN':
+      self.send(':fake.server 903 {} :SASL authentication successful'.\
+                                                          format(self.nick))
+
+  def irc_JOIN(self, rest):
+    for chan in rest.split()[0].split(','):
+      self.joined.add(chan)
+      self.send(':{0}!{0}@bench JOIN :{1}'.format(self.nick, chan))
+    if len(self.joined) == len(self.bench.channels):
+      self.bench.start(self)
+
+  def irc_PRIVMSG(self, rest):
+    target, _, _ = rest.partition(' ')
+    self.bench.replied(target)
+
+class FakeIRCFactory(protocol.ServerFactory):
+  protocol = FakeIRCServer
+
+  def __init__(self, bench):
+    self.bench = bench
+
+#------------------------------------------------------------#
+#                                                            #
+#                        BENCHMARK                           #
+#                                                            #
+#------------------------------------------------------------#
+class Opts(object):
+  '''
+  Stand-in for BotConfigParser holding
+  the bot's config.
+  '''
+  def __init__(self, main, plugins):
+    self.main = main
+    self.plugins = []
+    for name, opts in plugins.iteritems():
+      self.plugins.append(name)
+      setattr(self, name, opts)
+
+class LoadBench(object):
+  '''
+  Fires PRIVMSG traffic at the bot and
+  measures how long replies take.
+
+  Replies are matched to commands by their
+  target: a private reply completes the
+  command of its (unique) sender and a
+  channel reply the oldest pending command
+  in that channel.
+  '''
+  TICK = 0.01
+
+  def __init__(self, args):
+    self.args = args
+    self.channels = ['#bench{}'.format(i) for i in range(args.channels)]
+    self.latency = Metric(samples=None)
+    self.sent = 0
+    self.cmnds = 0
+    self.replies = 0
+    self.owed = 0.0
+    self.pending = {}     # target -> deque of command ids
+    self.started = {}     # command id -> time sent, until replied
+    self.start_time = None
+    self.stop_time = None
+
+  def start(self, ircd):
+    '''
+    Start sending traffic once the bot
+    has joined every channel.
+    '''
+    if self.start_time:
+      return
+    self.ircd = ircd
+    self.start_time = time.time()
+    self.loop = task.LoopingCall(self.tick)
+    self.loop.start(self.TICK)
+    reactor.callLater(self.args.duration, self.stop)
+
+  def tick(self):
+    self.owed += self.args.rate * self.TICK
+    while self.owed >= 1:
+      self.owed -= 1
+      self.send()
+
+  def send(self):
+    self.sent += 1
+    nick = 'u{}'.format(self.sent)
+    chan = random.choice(self.channels)
+    if random.random() < self.args.command_ratio:
+      line = random.choice(COMMANDS)
+      self.cmnds += 1
+      self.started[self.sent] = time.time()
+      self.pending.setdefault(chan, deque()).append(self.sent)
+      self.pending[nick] = deque([self.sent])
+    else:
+      line = random.choice(CHATTER)
+    self.ircd.send(':{0}!{0}@bench PRIVMSG {1} :{2}'.format(nick, chan, line))
+
+  def replied(self, target):
+    self.replies += 1
+    queue = self.pending.get(target)
+    while queue:
+      cmnd_id = queue.popleft()
+      if cmnd_id in self.started:
+        self.latency.record(time.time() - self.started.pop(cmnd_id))
+        break
+    if target in self.pending and not self.pending[target]:
+      del self.pending[target]
+
+  def stop(self):
+    '''
+    Stop sending and give outstanding
+    replies drain seconds to arrive.
+    '''
+    self.loop.stop()
+    self.stop_time = time.time()
+    reactor.callLater(self.args.drain, self.report)
+
+  def report(self):
+    elapsed = self.stop_time - self.start_time
+    summary = self.latency.summary()
+    results = { 'offered_msgs_per_sec': round(self.sent / elapsed, 2)
+              , 'commands': self.cmnds
+              , 'replies': self.replies
+              , 'unanswered': len(self.started)
+              , 'replies_per_sec': round(self.replies / elapsed, 2)
+              , 'latency_ms': dict((k, summary[k]) for k in \
+                                    ('mean', 'p50', 'p95', 'p99'))
+              , 'config': vars(self.args)
+              }
+    print json.dumps(results, indent=2, sort_keys=True)
+    if self.args.output:
+      with open(self.args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    reactor.stop()
+
+def make_fixtures(tmp):
+  '''
+  Write the files the plugins expect
+  into tmp and return their paths.
+  '''
+  csv_fname = os.path.join(tmp, 'currencyCodes.csv')
+  with open(csv_fname, 'w') as f:
+    f.write(CURRENCIES_CSV)
+
+  db_fname = os.path.join(tmp, 'cities.db')
+  con = sqlite3.connect(db_fname)
+  with con:
+    con.execute(CITIES_SQL)
+    con.execute('INSERT INTO cities (gid, name, asciiname, iso, population, '
+                'timezone) VALUES (1, "Paris", "Paris", "FR", 2138551, '
+                '"Europe/Paris")')
+    for name, cols in CitiesDB.INDEXES.items():
+      con.execute('CREATE INDEX {} ON cities ({})'.format(name, ', '.join(cols)))
+  con.close()
+
+  return csv_fname, db_fname
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='gilbertgrapesmom load benchmark')
+  parser.add_argument('--rate', type=float, default=100,
+                      help='PRIVMSG lines per second sent to the bot')
+  parser.add_argument('--channels', type=int, default=3)
+  parser.add_argument('--command-ratio', type=float, default=0.3,
+                      help='Share of lines which are commands')
+  parser.add_argument('--duration', type=float, default=20,
+                      help='Seconds of traffic to send')
+  parser.add_argument('--drain', type=float, default=5,
+                      help='Seconds to wait for replies after sending stops')
+  parser.add_argument('--latency', type=float, default=50,
+                      help='Milliseconds each upstream API call takes')
+  parser.add_argument('--workers', type=int, default=10)
+  parser.add_argument('--plugin-concurrency', type=int, default=2)
+  parser.add_argument('--plugin-loading', default='eager',
+                      choices=('eager', 'lazy', 'background'))
+  parser.add_argument('--reply-cache-size', type=int, default=1024,
+                      help='Replies cached by the bot (0 to disable)')
+  parser.add_argument('--line-rate', type=float, default=0,
+                      help='Bot lineRate in seconds (0 for unlimited)')
+  parser.add_argument('--output', help='Also write the results to this JSON file')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  tmp = tempfile.mkdtemp(prefix='ggm-bench-')
+  csv_fname, db_fname = make_fixtures(tmp)
+  bench = LoadBench(args)
+
+  # Local IRC server and upstream stub
+  ircd = reactor.listenTCP(0, FakeIRCFactory(bench), interface='127.0.0.1')
+  UpstreamStub.latency = args.latency / 1000.0
+  stub = ThreadingHTTPServer(('127.0.0.1', 0), UpstreamStub)
+  stub_thread = threading.Thread(target=stub.serve_forever)
+  stub_thread.daemon = True
+  stub_thread.start()
+  StubHTTPClient.stub = 'http://127.0.0.1:{}'.format(stub.server_address[1])
+  gilbertgrapesmom.HTTPClient = StubHTTPClient
+
+  main_opts = { 'server': '127.0.0.1'
+              , 'port': ircd.getHost().port
+              , 'channels': [c.lstrip('#') for c in bench.channels]
+              , 'nickname': 'ggm'
+              , 'username': 'ggm'
+              , 'realname': 'Bonnie'
+              , 'password': 'bench'
+              , 'lineRate': args.line_rate or None
+              , 'log': False
+              , 'logfile': os.path.join(tmp, 'ggm.log')
+              , 'workers': args.workers
+              , 'plugin_concurrency': args.plugin_concurrency
+              , 'http_timeout': 10.0
+              , 'dns_ttl': 300
+              , 'stats_file': os.path.join(tmp, 'stats.json')
+              , 'stats_interval': 300
+              , 'cache_dir': os.path.join(tmp, 'cache')
+              , 'plugin_loading': args.plugin_loading
+              , 'reply_cache_size': args.reply_cache_size
+              }
+  plugins = { 'btcavg': { 'module': 'BitcoinAverage'
+                        , 'callback': 'BitcoinAverage'
+                        , 'commands': 'avg avg-exchanges avg-ignored ' + \
+                                      'avg-rates avg-types'
+                        , 'default_currency': 'USD'
+                        }
+            , 'rate': { 'module': 'CryptoCoinCharts'
+                      , 'callback': 'CryptoCoinCharts'
+                      , 'commands': 'rate'
+                      , 'currencies_csv': csv_fname
+                      , 'default_currency': 'USD'
+                      }
+            , 'Lookup': { 'module': 'Lookup'
+                        , 'callback': 'Lookup'
+                        , 'commands': 'areacode ac city forex geoip'
+                        , 'cities_db': db_fname
+                        , 'cities_db_table': 'cities'
+                        , 'cities_select_limit': '5'
+                        , 'forex_update_secs': '60'
+                        , 'forex_base': 'USD'
+                        }
+            }
+
+  # Connect the bot, timing how long it takes
+  # to be ready to connect
+  start = time.time()
+  f = gilbertgrapesmom.GilbertGrapesMomFactory(Opts(main_opts, plugins))
+  print 'Factory ready in {:.3f}s'.format(time.time() - start)
+  reactor.connectTCP('127.0.0.1', f.port, f)
+
+  try:
+    reactor.run()
+  finally:
+    # Close keep-alive connections so the
+    # stub's threads exit before we do
+    f.http.session.close()
+    stub.shutdown()
+    time.sleep(0.1)
+    shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+  main()
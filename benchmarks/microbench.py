@@ -0,0 +1,280 @@
+#!/usr/bin/env python2
+'''
+Micro-benchmarks for the pure-CPU hot paths of gilbertgrapesmom.
+
+Each benchmark is run against synthetic data of growing size and
+the best and mean time per call are reported.  Results can be
+saved as JSON and later runs compared against a saved baseline,
+e.g.:
+
+  python2 benchmarks/microbench.py --save baseline.json
+  python2 benchmarks/microbench.py --compare baseline.json
+'''
+# Imports
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import string
+import sys
+import tempfile
+import timeit
+
+# The bot's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gilbertgrapesmom import build_help_and_info, CommandRegistry, CMND_PREFIX
+from plugins.BitcoinAverage import BitcoinAverage
+from plugins.Lookup import CitiesDB, Lookup
+from plugins.areacodes import areacodes
+from plugins.pluginbase import Plugin
+
+# Constants
+SIZES = { 'small': (10, 1000)
+        , 'medium': (100, 10000)
+        , 'large': (1000, 100000)
+        }
+CITIES_SQL = '''CREATE TABLE cities (
+    gid INTEGER NOT NULL UNIQUE, name TEXT, asciiname TEXT,
+    alternate_names TEXT, latitude REAL, longitude REAL,
+    feature_class TEXT, feature_code TEXT, iso TEXT, cc2 TEXT,
+    admin1_code TEXT, admin2_code TEXT, admin3_code TEXT,
+    admin4_code TEXT, population INTEGER, elevation INTEGER,
+    dem INTEGER, timezone TEXT, updated TEXT
+)'''
+
+#------------------------------------------------------------#
+#                                                            #
+#                     SYNTHETIC DATA                         #
+#                                                            #
+#------------------------------------------------------------#
+def word(rng, length=8):
+  return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+class SyntheticPlugin(Plugin):
+  '''
+  Plugin with n made up commands.
+  '''
+  def __init__(self, n, rng):
+    self.cmnds = dict((CMND_PREFIX + word(rng), self.handle) for _ in range(n))
+
+  def commands(self):
+    return self.cmnds.keys()
+
+  def get_commands(self):
+    return self.cmnds
+
+  def handle(self, msg):
+    return msg, False
+
+  def help(self, msg):
+    return msg, False
+
+  def info(self, msg):
+    return msg, False
+
+def bitcoin_average(n, rng):
+  '''
+  Return a BitcoinAverage with API data
+  for n markets, without any network.
+  '''
+  ba = BitcoinAverage.__new__(BitcoinAverage)
+  ba.api_data = {'USD': {}}
+  for _ in range(n):
+    price = rng.uniform(500, 700)
+    ba.api_data['USD'][word(rng)] = \
+        { 'volume_btc': rng.uniform(1, 10000)
+        , 'rates': {'ask': price + 1, 'bid': price - 1, 'last': price}
+        }
+  return ba
+
+def lookup(n, rng):
+  '''
+  Return a Lookup with forex rates for
+  n currencies, without any network.
+  '''
+  lu = Lookup.__new__(Lookup)
+  lu.forex_base = 'USD'
+  lu.forex_rates = dict((word(rng, 3).upper(), rng.uniform(0.01, 100)) \
+                            for _ in range(n))
+  lu.forex_rates['USD'] = 1.0
+  return lu
+
+def cities_db(n, rng, tmp):
+  '''
+  Return a CitiesDB over n synthetic,
+  indexed cities and a name present in it.
+  '''
+  fname = os.path.join(tmp, 'cities-{}.db'.format(n))
+  con = sqlite3.connect(fname)
+  names = [word(rng, 6).title() for _ in range(max(1, n / 10))]
+  with con:
+    con.execute(CITIES_SQL)
+    con.executemany(
+        'INSERT INTO cities (gid, name, asciiname, iso, population, timezone) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        ((i, name, name, rng.choice(['US', 'FR', 'DE']),
+          rng.randint(0, 10 ** 7), 'Etc/UTC') \
+            for i, name in ((i, rng.choice(names)) for i in xrange(n))))
+    for name, cols in CitiesDB.INDEXES.items():
+      con.execute('CREATE INDEX {} ON cities ({})'.format(name, ', '.join(cols)))
+  con.close()
+  return CitiesDB(fname, 'cities', cache_size=0), names[0]
+
+#------------------------------------------------------------#
+#                                                            #
+#                       BENCHMARKS                           #
+#                                                            #
+#------------------------------------------------------------#
+# Each benchmark takes the number of commands/markets/currencies
+# (n), the number of rows (rows), a random.Random and a temporary
+# directory and returns the function to be timed
+def bench_has_command(n, rows, rng, tmp):
+  plugin = SyntheticPlugin(n, rng)
+  msg = plugin.commands()[-1] + ' some args'
+  return lambda: plugin.has_command(msg)
+
+def bench_parse_command(n, rows, rng, tmp):
+  plugin = SyntheticPlugin(n, rng)
+  msg = plugin.commands()[-1] + ' some args'
+  return lambda: plugin.parse_command(msg)
+
+def bench_registry_lookup(n, rows, rng, tmp):
+  registry = CommandRegistry()
+  plugin = SyntheticPlugin(n, rng)
+  registry.register(plugin)
+  msgs = [ plugin.commands()[-1] + ' some args'
+         , '{}help {}'.format(CMND_PREFIX, plugin.commands()[0][1:])
+         , 'just some chatter without a command'
+         ]
+  return lambda: [registry.lookup(msg) for msg in msgs]
+
+def bench_build_help_and_info(n, rows, rng, tmp):
+  cmnds = [word(rng) for _ in range(n)]
+  return lambda: build_help_and_info(cmnds)
+
+def bench_avg(n, rows, rng, tmp):
+  ba = bitcoin_average(n, rng)
+  markets = ba.api_data['USD'].keys()
+  return lambda: ba.avg(markets, 'USD', 'last', 'weighted')
+
+def bench_weighted_avg(n, rows, rng, tmp):
+  values = [(1.0 / n, rng.uniform(500, 700)) for _ in range(n)]
+  ba = BitcoinAverage.__new__(BitcoinAverage)
+  return lambda: ba.weighted_avg(values)
+
+def bench_get_forex_rate(n, rows, rng, tmp):
+  lu = lookup(n, rng)
+  codes = [c for c in lu.forex_rates if c != 'USD']
+  cfrom, cto = codes[0], codes[-1]
+  return lambda: lu.get_forex_rate(cfrom, cto)
+
+def bench_areacode(n, rows, rng, tmp):
+  lu = Lookup.__new__(Lookup)
+  codes = [str(c) for c in rng.sample(areacodes.keys(), \
+                                          min(n, len(areacodes)))]
+  msg = '{}areacode {}'.format(CMND_PREFIX, ' '.join(codes))
+  return lambda: lu.areacode(msg)
+
+def bench_query_city(n, rows, rng, tmp):
+  cdb, name = cities_db(rows, rng, tmp)
+  kwargs = {'iso': True, 'population': True, 'timezone': True}
+  return lambda: cdb.query_city(name, 5, **kwargs)
+
+BENCHMARKS = sorted((name[len('bench_'):], f) for name, f in globals().items() \
+                        if name.startswith('bench_'))
+
+def run(names, sizes, repeat, seed):
+  '''
+  Return a dictionary of results where
+
+    k -> benchmark name
+    v -> dict of size -> timings in microseconds
+  '''
+  results = {}
+  tmp = tempfile.mkdtemp(prefix='ggm-microbench-')
+  try:
+    for name, bench in BENCHMARKS:
+      if names and name not in names:
+        continue
+      results[name] = {}
+      for size in sizes:
+        n, rows = SIZES[size]
+        f = bench(n, rows, random.Random(seed), tmp)
+
+        # Calibrate to ~0.1s per repetition
+        loops = 1
+        while timeit.timeit(f, number=loops) < 0.1 and loops < 10 ** 6:
+          loops *= 10
+        times = [t / loops * 10 ** 6 for t in \
+                    timeit.repeat(f, number=loops, repeat=repeat)]
+        results[name][size] = { 'best_us': round(min(times), 3)
+                              , 'mean_us': round(sum(times) / len(times), 3)
+                              , 'loops': loops
+                              }
+        print '{:<22} {:<7} best {:>12.3f}us  mean {:>12.3f}us'.format(
+                name, size, results[name][size]['best_us'],
+                results[name][size]['mean_us'])
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  return results
+
+def compare(results, baseline, threshold):
+  '''
+  Print the change of each result against
+  baseline and return a list of regressions
+  slower by more than threshold percent.
+  '''
+  regressions = []
+  print
+  print '{:<22} {:<7} {:>12} {:>12} {:>8}'.format(
+          'benchmark', 'size', 'baseline', 'current', 'change')
+  for name in sorted(results):
+    for size in sorted(results[name]):
+      if size not in baseline.get(name, {}):
+        continue
+      before = baseline[name][size]['best_us']
+      after = results[name][size]['best_us']
+      change = (after - before) / before * 100 if before else 0.0
+      flag = ''
+      if change > threshold:
+        flag = '  REGRESSION'
+        regressions.append((name, size, change))
+      print '{:<22} {:<7} {:>10.3f}us {:>10.3f}us {:>+7.1f}%{}'.format(
+              name, size, before, after, change, flag)
+  return regressions
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='gilbertgrapesmom micro-benchmarks')
+  parser.add_argument('names', nargs='*',
+                      help='Benchmarks to run (default all): ' + \
+                            ', '.join(name for name, _ in BENCHMARKS))
+  parser.add_argument('--sizes', nargs='+', default=sorted(SIZES),
+                      choices=sorted(SIZES))
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--save', help='Write the results to this JSON file')
+  parser.add_argument('--compare', help='Baseline JSON file to compare against')
+  parser.add_argument('--threshold', type=float, default=10.0,
+                      help='Percent slowdown counted as a regression')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  results = run(args.names, args.sizes, args.repeat, args.seed)
+
+  if args.save:
+    with open(args.save, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare(results, json.load(f), args.threshold)
+    if regressions:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
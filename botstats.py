@@ -0,0 +1,165 @@
+# Imports
+from collections import deque
+import json
+import os
+import threading
+import time
+
+from twisted.python import log
+
+class Metric(object):
+  '''
+  Metric counts calls and errors and keeps
+  a reservoir of the most recent latencies
+  for computing percentiles.
+
+  The reservoir holds the last samples
+  latencies only, not a histogram of all
+  of them, so percentiles are of recent
+  calls while count and mean cover all.
+
+  Recording is O(1); percentiles are only
+  computed when a summary is asked for.
+  '''
+  def __init__(self, samples=1024):
+    self.count = 0
+    self.errors = 0
+    self.total = 0.0
+    self.latencies = deque(maxlen=samples)
+
+  def record(self, secs, error=False):
+    self.count += 1
+    self.total += secs
+    self.latencies.append(secs)
+    if error:
+      self.errors += 1
+
+  def percentile(self, latencies, pct):
+    '''
+    Return the pct percentile of the
+    sorted list latencies.
+    '''
+    if not latencies:
+      return 0.0
+    return latencies[int(round(pct / 100.0 * (len(latencies) - 1)))]
+
+  def summary(self):
+    '''
+    Return a dictionary of the count, errors
+    and mean, p50, p95 and p99 latencies in
+    milliseconds.
+    '''
+    latencies = sorted(self.latencies)
+    ms = lambda secs: round(secs * 1000, 2)
+    return { 'count': self.count
+           , 'errors': self.errors
+           , 'mean': ms(self.total / self.count) if self.count else 0.0
+           , 'p50': ms(self.percentile(latencies, 50))
+           , 'p95': ms(self.percentile(latencies, 95))
+           , 'p99': ms(self.percentile(latencies, 99))
+           }
+
+class Stats(object):
+  '''
+  Stats keeps in-memory latency and
+  throughput metrics for the bot.
+
+  Metrics are grouped, e.g., commands,
+  plugins, phases, upstreams, where each
+  group is a dictionary of:
+
+    k -> name of what was timed
+    v -> Metric
+
+  Time spent in HTTP requests is added up
+  per thread so it can be attributed to
+  the command running in that thread.
+  '''
+  def __init__(self):
+    self.started = time.time()
+    self.lock = threading.Lock()
+    self.groups = {}
+    self.local = threading.local()
+
+  def record(self, group, name, secs, error=False):
+    '''
+    Record a latency of secs for name
+    in group.
+    '''
+    with self.lock:
+      metrics = self.groups.setdefault(group, {})
+      if name not in metrics:
+        metrics[name] = Metric()
+      metrics[name].record(secs, error)
+
+  def record_http(self, host, secs, error=False):
+    '''
+    Record an upstream HTTP request to host
+    and add it to the HTTP time of the
+    command running in this thread.
+    '''
+    self.record('upstreams', host, secs, error)
+    if getattr(self.local, 'http', None) is not None:
+      self.local.http += secs
+
+  def timed(self, names, f, *args, **kwargs):
+    '''
+    Call f(*args, **kwargs) and record its
+    latency under every (group, name) 2-tuple
+    in names, along with the time it spent
+    in HTTP requests, if any, under the http
+    phase.
+
+    Return the result of f.
+    '''
+    self.local.http = 0.0
+    error = False
+    start = time.time()
+    try:
+      return f(*args, **kwargs)
+    except:
+      error = True
+      raise
+    finally:
+      elapsed = time.time() - start
+      for group, name in names:
+        self.record(group, name, elapsed, error)
+      if self.local.http:
+        self.record('phases', 'http', self.local.http)
+      self.local.http = None
+
+  def summary(self, group):
+    '''
+    Return a dictionary of metric summaries
+    for group.
+    '''
+    with self.lock:
+      return dict((name, metric.summary()) for name, metric \
+                      in self.groups.get(group, {}).iteritems())
+
+  def snapshot(self):
+    '''
+    Return a dictionary of all metric
+    summaries along with the uptime.
+    '''
+    with self.lock:
+      groups = self.groups.keys()
+    snap = dict((group, self.summary(group)) for group in groups)
+    snap['uptime'] = round(time.time() - self.started, 2)
+    return snap
+
+  def dump(self, fname):
+    '''
+    Write a JSON snapshot of all metrics
+    to fname.
+
+    Failures are logged rather than raised
+    so periodic dumps carry on.
+    '''
+    tmp = fname + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+      os.rename(tmp, fname)
+    except (IOError, OSError), exc:
+      log.err('[Error]: Cannot dump stats to {}: {}'.format(fname, exc))
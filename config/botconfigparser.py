@@ -64,6 +64,43 @@ class BotConfigParser:
         self.main['lineRate'] = cp.getint('main', 'lineRate')
         self.main['log'] = cp.getboolean('main', 'log')
         self.main['logfile'] = cp.get('main', 'logfile')
+
+        # Optional size of the worker pool running plugin
+        # handlers and the default per-plugin cap on it
+        self.main['workers'] = cp.getint('main', 'workers') \
+                        if cp.has_option('main', 'workers') else 10
+        self.main['plugin_concurrency'] = \
+                        cp.getint('main', 'plugin_concurrency') \
+                        if cp.has_option('main', 'plugin_concurrency') else 2
+
+        # Optional default timeout for HTTP requests made
+        # by plugins and seconds to cache DNS lookups
+        self.main['http_timeout'] = cp.getfloat('main', 'http_timeout') \
+                        if cp.has_option('main', 'http_timeout') else 10.0
+        self.main['dns_ttl'] = cp.getint('main', 'dns_ttl') \
+                        if cp.has_option('main', 'dns_ttl') else 300
+
+        # Optional JSON file metrics are dumped to
+        # and how often (in seconds) to dump them
+        self.main['stats_file'] = cp.get('main', 'stats_file') \
+                        if cp.has_option('main', 'stats_file') \
+                        else 'logs/stats.json'
+        self.main['stats_interval'] = cp.getint('main', 'stats_interval') \
+                        if cp.has_option('main', 'stats_interval') else 300
+
+        # Optional directory plugins cache upstream data in
+        # to start without waiting on the network
+        self.main['cache_dir'] = cp.get('main', 'cache_dir') \
+                        if cp.has_option('main', 'cache_dir') else 'cache'
+
+        # Optional plugin loading mode, one of eager, lazy
+        # or background
+        self.main['plugin_loading'] = cp.get('main', 'plugin_loading') \
+                        if cp.has_option('main', 'plugin_loading') else 'eager'
+
+        # Optional number of command replies cached
+        self.main['reply_cache_size'] = cp.getint('main', 'reply_cache_size') \
+                        if cp.has_option('main', 'reply_cache_size') else 1024
       else:
         # Save the plugin's name
         self.plugins.append(section)
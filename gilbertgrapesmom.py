@@ -1,12 +1,21 @@
 # Imports
+from collections import deque, namedtuple
 import os
 import time
 
 from twisted.internet import protocol
+from twisted.internet import reactor
 from twisted.internet import ssl
+from twisted.internet import task
 from twisted.python import log
 from twisted.words.protocols import irc
 
+from botstats import Stats
+from httpclient import HTTPClient
+from pluginloader import LazyPlugin, load_plugin
+from replycache import ReplyCache
+from workerpool import WorkerPool
+
 # Constants
 CMND_PREFIX = '?'  # For the built-in commands for the bot
 
@@ -23,6 +32,141 @@ def build_help_and_info(cmnds, prefix=CMND_PREFIX):
       addtl_cmnds.append('{}{} {}'.format(CMND_PREFIX, pre_cmnd, cmnd))
   return addtl_cmnds
 
+# A routing target where:
+#   plugin:  object owning the command
+#   command: name the line was routed on
+#   handler: method answering the command
+CommandEntry = namedtuple('CommandEntry', 'plugin command handler')
+
+class CommandRegistry(object):
+  '''
+  CommandRegistry maps every command, alias
+  and help/info variant of the loaded plugins
+  straight to the plugin owning it.
+
+  It is built once when plugins are loaded
+  so routing a line is a dictionary lookup
+  on its first token(s) no matter how many
+  plugins are loaded.
+
+  Plugins with a passive trigger, i.e., a
+  Plugin.trigger name and a has_trigger
+  method, are checked in load order for
+  any line no command matched.
+  '''
+  def __init__(self):
+    # Dictionaries of commands where
+    #   k -> prefixed command, or a
+    #        (help|info, command) 2-tuple
+    #   v -> CommandEntry
+    self.cmnds = {}
+    self.help_and_info = {}
+
+    # CommandEntry for passive triggers
+    self.triggers = []
+
+  def add(self, table, key, entry):
+    '''
+    Add entry to table under key.
+
+    Return False if key is owned by a
+    different plugin, even one of the same
+    class such as two LazyPlugin proxies,
+    and True otherwise.
+    '''
+    owner = table.get(key)
+    if owner and owner.plugin is not entry.plugin:
+      return False
+
+    table[key] = entry
+    return True
+
+  def register(self, plugin, help_and_info=True):
+    '''
+    Register all commands returned by the
+    get_commands method of plugin along with
+    their help and info variants.
+
+    Returns a list of duplicate commands
+    which were not registered.
+    '''
+    dups = []
+    for cmnd, cmnd_cb in plugin.get_commands().iteritems():
+      if not self.add(self.cmnds, cmnd, CommandEntry(plugin, cmnd, cmnd_cb)):
+        dups.append(cmnd)
+
+      if not help_and_info:
+        continue
+
+      for pre_cmnd in ['help', 'info']:
+        key = (CMND_PREFIX + pre_cmnd, cmnd[len(CMND_PREFIX):])
+        entry = CommandEntry( plugin
+                            , ' '.join(key)
+                            , getattr(plugin, pre_cmnd)
+                            )
+        self.add(self.help_and_info, key, entry)
+
+    # Save any passive trigger
+    if getattr(plugin, 'trigger', None):
+      self.triggers.append(CommandEntry( plugin
+                                       , plugin.trigger
+                                       , plugin.has_trigger
+                                       ))
+
+    # Report duplicates at load time
+    if dups:
+      log.err('[Error]: Duplicate commands from {} ignored: {}'.format(
+                            getattr(plugin, 'callback', plugin.__class__.__name__)
+                          , ', '.join(dups)))
+
+    return dups
+
+  def unregister(self, plugin):
+    '''
+    Remove all commands and triggers
+    of plugin.
+    '''
+    for table in (self.cmnds, self.help_and_info):
+      for key, entry in table.items():
+        if entry.plugin is plugin:
+          del table[key]
+    self.triggers = [e for e in self.triggers if e.plugin is not plugin]
+
+  def commands(self):
+    '''
+    Return a list of all registered
+    commands.
+    '''
+    return self.cmnds.keys()
+
+  def lookup(self, msg):
+    '''
+    Return the CommandEntry responsible
+    for msg or None if no plugin handles it.
+    '''
+    tokens = msg.split(None, 2)
+    if not tokens:
+      return None
+
+    # Help or info about a command, e.g.,
+    # ?help avg or ?help ?avg
+    if len(tokens) > 1:
+      key = (tokens[0], tokens[1][len(CMND_PREFIX):] \
+                          if tokens[1].startswith(CMND_PREFIX) else tokens[1])
+      if key in self.help_and_info:
+        return self.help_and_info[key]
+
+    # A plain command
+    if tokens[0] in self.cmnds:
+      return self.cmnds[tokens[0]]
+
+    # Finally, passive triggers
+    for entry in self.triggers:
+      if entry.handler(msg):
+        return entry
+
+    return None
+
 class GilbertGrapesMom(irc.IRCClient):
     '''
     GilbertGrapesMom class implements the
@@ -37,9 +181,6 @@ class GilbertGrapesMom(irc.IRCClient):
       '''
       Constructor for GilbertGrapesMom
       '''
-      # TO-DO: Check for duplicate commands
-      #        from instantiated plugins
-
       # Dictionary of supported built-in
       # commands where
       #   key: command 
@@ -48,9 +189,14 @@ class GilbertGrapesMom(irc.IRCClient):
                    , 'help': self.help
                    , 'info': self.info
                    , 'commands': self.commands
+                   , 'stats': self.stats
                    }
       self.cmnds = dict((CMND_PREFIX+k, v) for k, v in self.cmnds.items())
 
+      # Times lines were queued to be sent
+      # for measuring the outbound wait
+      self.queued = deque()
+
     def sasl(self):
       '''
       SASL authentication code from:
@@ -108,12 +254,53 @@ class GilbertGrapesMom(irc.IRCClient):
       Method for returning a list of all the
       commands supported by the bot.
       '''
-      commands = [cmnd for cmnd in self.cmnds.keys()]
-      map( lambda x: commands.extend(x.commands())
-         , [cb for cb in self.fact.callbacks \
-             if not cb.__class__.__name__ == 'GilbertGrapesMom']
-         )
-      return ','.join(sorted(commands)), False
+      return ','.join(sorted(self.fact.registry.commands())), False
+
+    def stats(self, msg):
+      '''
+      Method for returning latency and
+      throughput of commands.
+
+      Takes an optional command to see only
+      its metrics.
+      '''
+      stats = self.fact.stats
+      fmt = lambda name, s: '{} n={} err={} p50={} p95={} p99={}ms'.format(
+                  name, s['count'], s['errors'], s['p50'], s['p95'], s['p99'])
+
+      # Metrics for a single command
+      cmnds = stats.summary('commands')
+      args = msg.split()[1:]
+      if args:
+        name = args[0] if args[0].startswith(CMND_PREFIX) \
+                                else CMND_PREFIX + args[0]
+        if name not in cmnds:
+          return 'No stats for {}'.format(name), False
+        hits, misses = self.fact.replies.counters.get(name, (0, 0))
+        return fmt(name, cmnds[name]) + \
+                  ' cache hits={} misses={}'.format(hits, misses), False
+
+      # The busiest commands and each phase
+      busiest = sorted( cmnds.iteritems()
+                      , key=lambda x: x[1]['count']
+                      , reverse=True
+                      )[:5]
+      phases = sorted(stats.summary('phases').iteritems())
+      replies = self.fact.replies.summary()
+      reply = [ '[Uptime]: {}s'.format(int(time.time() - stats.started))
+              , '[Commands]: ' + ' | '.join(fmt(*c) for c in busiest)
+              , '[Phases]: ' + ' | '.join(fmt(*p) for p in phases)
+              , '[Reply cache]: size={size} hits={hits} misses={misses}'.format(
+                                                                    **replies)
+              ]
+      return '\n'.join(reply), True
+
+    def get_commands(self):
+      '''
+      Return the dictionary of built-in
+      commands.
+      '''
+      return self.cmnds
 
     def has_command(self, msg):
       '''
@@ -184,6 +371,10 @@ class GilbertGrapesMom(irc.IRCClient):
         chan = chan if chan.startswith('#') else '#' + chan
         self.join(chan)
 
+      # Load plugins in the background
+      if self.fact.plugin_loading == 'background':
+        self.fact.load_plugins()
+
     def joined(self, channel):
       '''
       Called when a channel is joined.
@@ -218,13 +409,79 @@ class GilbertGrapesMom(irc.IRCClient):
       # Log all commands received
       log.msg('[{}@{}]: {}'.format(user, channel, msg))
 
-      # Check each plugin callback to see
-      # if the current message has a command
-      for cb in self.fact.callbacks:
-        if cb.has_command(msg):
-          reply, priv = cb.parse_command(msg)
-          self.msg(sender if priv else sendTo, str(reply))
-          break
+      # Route the message to the plugin
+      # owning its command, if any, and
+      # run it off the reactor thread
+      start = time.time()
+      entry = self.fact.registry.lookup(msg)
+      self.fact.stats.record('phases', 'lookup', time.time() - start)
+      if entry:
+        d = self.fact.pool.run( entry.plugin
+                              , self.run_command
+                              , entry
+                              , msg
+                              , time.time()
+                              )
+        d.addCallback(self.reply, sender, sendTo)
+        d.addErrback(self.command_failed, entry)
+
+    def run_command(self, entry, msg, queued):
+      '''
+      Called in a worker thread to have the
+      plugin in entry parse msg, or answer
+      from the reply cache, timing how long
+      it waited for a worker and how long
+      it took.
+      '''
+      stats = self.fact.stats
+      stats.record('phases', 'pool', time.time() - queued)
+      return stats.timed( [ ('commands', entry.command)
+                          , ('plugins', entry.plugin.__class__.__name__)
+                          , ('phases', 'handler')
+                          ]
+                        , self.fact.replies.call
+                        , entry.plugin
+                        , entry.command
+                        , entry.plugin.parse_command
+                        , msg
+                        )
+
+    def reply(self, result, sender, sendTo):
+      '''
+      Send the (reply, priv) result of a
+      command either to sender or sendTo.
+      '''
+      if not result:
+        return
+      reply, priv = result
+      self.msg(sender if priv else sendTo, str(reply))
+
+    def command_failed(self, failure, entry):
+      '''
+      Log a command that raised an error.
+      '''
+      log.err(failure, '[Error]: {} from {} failed'.format(
+                          entry.command, entry.plugin.__class__.__name__))
+
+    def sendLine(self, line):
+      '''
+      Note when line was queued before
+      it is rate limited by lineRate.
+      '''
+      self.queued.append(time.time())
+      irc.IRCClient.sendLine(self, line)
+
+    def _reallySendLine(self, line):
+      '''
+      Record how long line waited in
+      the outbound queue.
+      '''
+      if self.queued:
+        self.fact.stats.record( 'phases'
+                              , 'outbound'
+                              , time.time() - self.queued.popleft()
+                              )
+      irc.IRCClient._reallySendLine(self, line)
 
 class GilbertGrapesMomFactory(protocol.ClientFactory):
   '''
@@ -245,35 +502,114 @@ class GilbertGrapesMomFactory(protocol.ClientFactory):
 
     # Next, save the list of plugins 
     # and their associated dict args,
-    # modules and callbacks
-    self.imports = set()
+    # modules, callbacks and any
+    # commands declared for them
+    self.modules = {}
     self.args = {}
+    self.declared = {}
     for plugin in opts.plugins:
       exec 'self.{p} = opts.{p}'.format(p=plugin)
-      self.imports.add('from plugins.{} import {}'.format(
-                                      eval('opts.{}["module"]'.format(plugin)),
-                                      eval('opts.{}["callback"]'.format(plugin))))
+      cb_name = eval('opts.{}'.format(plugin))['callback']
+      self.modules[cb_name] = eval('opts.{}["module"]'.format(plugin))
+
+      # Save declared commands
+      cmnds = eval('opts.{}'.format(plugin)).get('commands', '')
+      self.declared.setdefault(cb_name, []).extend([ CMND_PREFIX + c \
+                                  for c in cmnds.replace(',', ' ').split()])
 
       # Use the rest of the options as the dict
       # argument to the callback's constructor
-      cb_name = eval('opts.{}'.format(plugin))['callback']
       args_dict = dict((k, v) for k,v in \
                         eval('opts.{}'.format(plugin)).items() \
-                          if k not in ('module', 'callback'))
+                          if k not in ('module', 'callback', 'commands'))
       if not cb_name in self.args:
         self.args[cb_name] = args_dict
       else:
         self.args[cb_name].update(args_dict)
 
+    # Latency and throughput metrics,
+    # periodically dumped as JSON
+    self.stats = Stats()
+    self.stats_loop = task.LoopingCall(self.stats.dump, self.stats_file)
+    reactor.callWhenRunning( self.stats_loop.start
+                           , self.stats_interval
+                           , now=False
+                           )
+
+    # Replies of idempotent commands shared
+    # by all channels and connections
+    self.replies = ReplyCache(self.reply_cache_size)
+
+    # Pool of threads running plugin commands
+    self.pool = WorkerPool(self.workers, self.plugin_concurrency)
+
+    # HTTP client shared by all plugins
+    self.http = HTTPClient( self.pool
+                          , timeout=self.http_timeout
+                          , pool_size=self.workers
+                          , dns_ttl=self.dns_ttl
+                          , stats=self.stats
+                          )
+
     # Import the plugin modules
     # and instantiate objects for
-    # each of the callbacks
+    # each of the callbacks, which
+    # are handed the HTTP client and
+    # where to cache upstream data.
+    #
+    # Unless plugin_loading is eager,
+    # plugins with declared commands
+    # get a LazyPlugin in their place
+    # until first used; in background
+    # mode all are loaded once signed on.
+    # Plugins declaring none, e.g., with
+    # only a passive trigger, are loaded
+    # at once as no command would load them
     self.callbacks = []
-    for import_stmt in self.imports:
-      exec import_stmt
+    self.registry = CommandRegistry()
+    for cb, module in sorted(self.modules.items()):
+      self.args[cb]['http'] = self.http
+      self.args[cb]['cache_dir'] = self.cache_dir
 
-      for cb in import_stmt.split()[-1].split(','):
-        self.callbacks.append(eval('{}({})'.format(cb, self.args[cb])))
+      if self.plugin_loading == 'eager' or not self.declared[cb]:
+        self.plugin_loaded(None, load_plugin(module, cb, self.args[cb]))
+      else:
+        self.plugin_loaded(None, LazyPlugin( module
+                                           , cb
+                                           , self.args[cb]
+                                           , self.declared[cb]
+                                           , self.plugin_loaded
+                                           ))
+
+  def plugin_loaded(self, proxy, plugin):
+    '''
+    Index the commands of plugin, in place
+    of the LazyPlugin proxy if any, report
+    duplicates and refresh its upstream data
+    in the background, dropping its cached
+    replies on every refresh.
+    '''
+    if proxy:
+      self.registry.unregister(proxy)
+      self.callbacks.remove(proxy)
+      self.pool.forget(proxy)
+
+    self.callbacks.append(plugin)
+    self.registry.register(plugin)
+    for refresher in plugin.refreshers():
+      refresher.subscribe(lambda plugin=plugin: self.replies.invalidate(plugin))
+      refresher.start(self.pool)
+
+  def load_plugins(self):
+    '''
+    Load every plugin still waiting for
+    its first use in the worker pool, all
+    at once.
+    '''
+    for cb in list(self.callbacks):
+      if isinstance(cb, LazyPlugin):
+        d = self.pool.run(cb, cb.load)
+        d.addErrback(log.err, '[Error]: Loading {} failed'.format(cb.callback))
 
   def buildProtocol(self, addr):
     '''
@@ -289,8 +625,15 @@ class GilbertGrapesMomFactory(protocol.ClientFactory):
     for info in ['nickname', 'username', 'realname', 'lineRate']:
       exec 'ggm.{0} = self.{0}'.format(info)
 
-    # Save the GGM object as a callback
+    # Replace the GGM object of any previous
+    # connection as a callback and route
+    # its built-in commands to this one
+    for cb in [cb for cb in self.callbacks if isinstance(cb, GilbertGrapesMom)]:
+      self.registry.unregister(cb)
+      self.callbacks.remove(cb)
+      self.pool.forget(cb)
     self.callbacks.append(ggm)
+    self.registry.register(ggm, help_and_info=False)
 
     return ggm
 
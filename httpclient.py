@@ -0,0 +1,229 @@
+# Imports
+import socket
+import time
+import urlparse
+
+import requests
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from requests.packages.urllib3.exceptions import NewConnectionError
+from requests.packages.urllib3.util.connection import allowed_gai_family
+
+from singleflight import SingleFlight
+from ttlcache import MISS, TTLCache
+
+class DNSCache(object):
+  '''
+  DNSCache resolves host names for the
+  connections of one HTTPClient, caching
+  successful lookups for ttl seconds, at
+  most size of them, so repeated requests
+  to the same upstream skip the resolver.
+  '''
+  def __init__(self, ttl, size=256):
+    self.ttl = ttl
+    self.cache = TTLCache(size)
+
+  def __call__(self, host, port, family=0, socktype=0):
+    key = (host, port, family, socktype)
+    addrs = self.cache.get(key)
+    if addrs is MISS:
+      addrs = socket.getaddrinfo(host, port, family, socktype)
+      self.cache.put(key, addrs, self.ttl)
+    return addrs
+
+def connect( address, timeout, resolve, source_address=None
+           , socket_options=None):
+  '''
+  Return a socket connected to address, a
+  (host, port) 2-tuple, trying in turn each
+  address resolve gives for it, as urllib3's
+  create_connection does.
+  '''
+  host, port = address
+  error = None
+  for af, socktype, proto, _, sa in resolve( host.strip('[]'), port
+                                           , allowed_gai_family()
+                                           , socket.SOCK_STREAM):
+    sock = None
+    try:
+      sock = socket.socket(af, socktype, proto)
+      for opt in socket_options or []:
+        sock.setsockopt(*opt)
+      if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+        sock.settimeout(timeout)
+      if source_address:
+        sock.bind(source_address)
+      sock.connect(sa)
+      return sock
+    except socket.error, e:
+      error = e
+      if sock is not None:
+        sock.close()
+
+  raise error or socket.error('getaddrinfo returns an empty list')
+
+class CachedDNSConnection(object):
+  '''
+  Mixin of urllib3 connections resolving
+  their host with the DNSCache resolve.
+  '''
+  resolve = None
+
+  def _new_conn(self):
+    try:
+      return connect( (self._dns_host, self.port), self.timeout, self.resolve
+                    , self.source_address, self.socket_options)
+    except socket.timeout:
+      raise ConnectTimeoutError(self,
+                'Connection to {} timed out. (connect timeout={})'.format(
+                                                      self.host, self.timeout))
+    except socket.error, e:
+      raise NewConnectionError(self,
+                'Failed to establish a new connection: {}'.format(e))
+
+class CachedDNSAdapter(requests.adapters.HTTPAdapter):
+  '''
+  CachedDNSAdapter is an HTTPAdapter whose
+  connections resolve hosts with dns, a
+  DNSCache, leaving socket.getaddrinfo
+  untouched for the rest of the process.
+  '''
+  def __init__(self, dns, **kwargs):
+    self.dns = dns
+    super(CachedDNSAdapter, self).__init__(**kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    super(CachedDNSAdapter, self).init_poolmanager(*args, **kwargs)
+
+    # Pools of connections bound to dns
+    def pool_class(base):
+      conn = type( 'CachedDNS' + base.ConnectionCls.__name__
+                 , (CachedDNSConnection, base.ConnectionCls)
+                 , {'resolve': self.dns}
+                 )
+      return type('CachedDNS' + base.__name__, (base,), {'ConnectionCls': conn})
+
+    self.poolmanager.pool_classes_by_scheme = \
+                                { 'http': pool_class(HTTPConnectionPool)
+                                , 'https': pool_class(HTTPSConnectionPool)
+                                }
+
+class HTTPClient(object):
+  '''
+  HTTPClient is the HTTP service shared by
+  all plugins.
+
+  It keeps a pool of keep-alive connections
+  per host, caches DNS lookups, asks for
+  gzip'ed responses and applies a default
+  timeout to every request.
+
+  The get, post and head methods block and
+  are meant for plugin commands, which run
+  in the worker pool. The coalesced method
+  shares one response between concurrent
+  identical requests. The deferred method
+  runs a request in the worker pool and
+  returns a Deferred for use on the reactor
+  thread.
+
+  When given a Stats object, the latency
+  of every request is recorded per host.
+  '''
+  def __init__( self, pool, timeout=10, pool_size=10, dns_ttl=300
+              , stats=None, dns_cache_size=256):
+    '''
+    Sets up a requests Session with
+    connection pools holding up to
+    pool_size connections per host.
+
+    Params:
+      @pool: WorkerPool running deferred requests
+      @timeout: default timeout in seconds
+      @pool_size: max connections kept per host
+      @dns_ttl: seconds to cache DNS lookups (0 to disable)
+      @stats: Stats recording request latencies
+      @dns_cache_size: most DNS lookups cached
+    '''
+    self.pool = pool
+    self.stats = stats
+    self.timeout = float(timeout)
+    self.max_concurrency = int(pool_size)
+
+    # One session so connections are reused,
+    # resolving hosts through a DNS cache of
+    # its own
+    self.session = requests.Session()
+    pool_kwargs = { 'pool_connections': int(pool_size)
+                  , 'pool_maxsize': int(pool_size)
+                  }
+    if int(dns_ttl) > 0:
+      self.dns = DNSCache(int(dns_ttl), dns_cache_size)
+      adapter = CachedDNSAdapter(self.dns, **pool_kwargs)
+    else:
+      self.dns = None
+      adapter = requests.adapters.HTTPAdapter(**pool_kwargs)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.session.headers.update({ 'User-Agent': 'ggm IRC bot'
+                                , 'Accept-Encoding': 'gzip, deflate'
+                                })
+
+    # Identical requests in progress
+    self.flights = SingleFlight()
+
+  def request(self, method, url, **kwargs):
+    '''
+    Make a request and return the
+    requests Response object.
+    '''
+    kwargs.setdefault('timeout', self.timeout)
+    if not self.stats:
+      return self.session.request(method, url, **kwargs)
+
+    error = True
+    start = time.time()
+    try:
+      r = self.session.request(method, url, **kwargs)
+      error = r.status_code >= 400
+      return r
+    finally:
+      self.stats.record_http( urlparse.urlparse(url).netloc
+                            , time.time() - start
+                            , error
+                            )
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def head(self, url, **kwargs):
+    return self.request('HEAD', url, **kwargs)
+
+  def coalesced(self, method, url, **kwargs):
+    '''
+    Make a request, or wait for an identical
+    one already in progress, and return the
+    requests Response object, whose body is
+    read before it is shared.
+    '''
+    def fetch():
+      r = self.request(method, url, **kwargs)
+      r.content
+      return r
+
+    key = (method, url, repr(sorted(kwargs.items())))
+    return self.flights.do(key, fetch)
+
+  def deferred(self, method, url, **kwargs):
+    '''
+    Make a request in the worker pool.
+
+    Return a Deferred firing with the
+    requests Response object.
+    '''
+    return self.pool.run(self, self.request, method, url, **kwargs)
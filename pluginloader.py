@@ -0,0 +1,88 @@
+# Imports
+import importlib
+import threading
+
+from twisted.internet import reactor
+
+def load_plugin(module, callback, args):
+  '''
+  Import plugins.<module> and return an
+  instance of its callback class built
+  with the args dict.
+  '''
+  mod = importlib.import_module('plugins.' + module)
+  return getattr(mod, callback)(args)
+
+class LazyPlugin(object):
+  '''
+  LazyPlugin stands in for a plugin whose
+  commands are declared in the config, so
+  the plugin module is only imported and
+  its callback instantiated when one of
+  those commands is first used, or when
+  load is called in the background.
+
+  Once loaded, on_load(proxy, plugin) is
+  called on the reactor thread so the
+  plugin can take the proxy's place.
+  '''
+  trigger = None
+
+  def __init__(self, module, callback, args, cmnds, on_load):
+    '''
+    Params:
+      @module: plugin module in plugins
+      @callback: plugin class in module
+      @args: dict passed to the plugin's constructor
+      @cmnds: prefixed commands the plugin handles
+      @on_load: called with the proxy and the plugin
+    '''
+    self.module = module
+    self.callback = callback
+    self.args = args
+    self.on_load = on_load
+    self.plugin = None
+    self.lock = threading.Lock()
+
+    # Share the plugin's concurrency cap
+    if 'max_concurrency' in args:
+      self.max_concurrency = args['max_concurrency']
+
+    # Every command loads the plugin and
+    # is then handled by it
+    self.cmnds = dict((cmnd, self.parse_command) for cmnd in cmnds)
+
+  def load(self):
+    '''
+    Import and instantiate the plugin,
+    once, and return it.
+    '''
+    with self.lock:
+      if self.plugin is None:
+        self.plugin = load_plugin(self.module, self.callback, self.args)
+        reactor.callFromThread(self.on_load, self, self.plugin)
+    return self.plugin
+
+  def commands(self):
+    return self.cmnds.keys()
+
+  def get_commands(self):
+    return self.cmnds
+
+  def refreshers(self):
+    return []
+
+  def cache_ttls(self):
+    return {}
+
+  def cacheable(self, cmnd, reply):
+    return False
+
+  def parse_command(self, msg):
+    return self.load().parse_command(msg)
+
+  def help(self, msg):
+    return self.load().help(msg)
+
+  def info(self, msg):
+    return self.load().info(msg)
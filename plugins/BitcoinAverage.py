@@ -1,15 +1,13 @@
 # Imports
 import argparse
-import datetime
 import functools
 import itertools as it
 import json
 import sys
 
-import requests
-
 from gilbertgrapesmom import build_help_and_info, CMND_PREFIX
 from pluginbase import Plugin
+from refresher import Refresher
 from twisted.python import log
 
 class ArgParserError(Exception): pass
@@ -33,12 +31,6 @@ class BitcoinAverage(Plugin):
     for arg, val in args.iteritems():
       setattr(self, arg, val)
 
-    # Cache the time of the last
-    # update so no more than a 
-    # given number of API calls
-    # occur in a particular time
-    self.last_update = None
-
     # API link for average data
     self.api = 'https://api.bitcoinaverage.com/exchanges/all'
 
@@ -57,8 +49,21 @@ class BitcoinAverage(Plugin):
     # All supported exchanges (filled in later)
     self.exchanges = {}
 
-    # Get fresh data
-    self.get_fresh_data()
+    # Build a parser
+    self.build_parser()
+
+    # Start from cached data or get fresh data,
+    # then keep it fresh in the background at
+    # most once a minute
+    self.refresher = Refresher( 'BitcoinAverage'
+                              , self.pull_data
+                              , self.use_data
+                              , getattr(self, 'refresh_secs', 60)
+                              , getattr(self, 'max_stale_secs', 600)
+                              , cache=self.cache_file('BitcoinAverage')
+                              )
+    if not self.refresher.load():
+      self.refresher.ensure()
 
     # Build a dictionary of commands
     self.cmnds = { 'avg': self.parse_avg
@@ -75,6 +80,20 @@ class BitcoinAverage(Plugin):
     '''
     return self.cmnds.keys()
 
+  def refreshers(self):
+    '''
+    Returns the refresher for API data
+    '''
+    return [self.refresher]
+
+  def cache_ttls(self):
+    '''
+    Replies only change with the API
+    data, so cache them until the next
+    refresh
+    '''
+    return dict((cmnd, self.refresher.interval) for cmnd in self.cmnds)
+
   def get_commands(self):
     '''
     Return the command dicts
@@ -224,76 +243,82 @@ class BitcoinAverage(Plugin):
     '''
     Return True if API data is stale.
     '''
-    # See if a pull from the API
-    # has never been made
-    if not self.last_update:
-      return True
-
-    return (datetime.datetime.utcnow() - self.last_update).seconds > 60
+    return self.refresher.stale()
 
   def get_fresh_data(self):
     '''
     Pulls fresh API data and saves it as a 
-    dictionary. 
+    dictionary, sharing any pull already
+    in progress.
 
     Returns True if pull was successful and
     False otherwise.
     '''
+    return self.refresher.fetch()
+
+  def pull_data(self):
+    '''
+    Returns a dict of the raw average and
+    ignored exchanges API data, or None
+    if the pull failed.
+    '''
     try:
       # Grab average data
-      r = requests.get(self.api)
+      r = self.http.get(self.api)
       if r.status_code != 200:
         log.err('[Error]: Status code {} during API pull'.format(
                                                       r.status_code))
-        return False
-      else:
-        self.api_data = r.json()
-        self.last_update = datetime.datetime.utcnow() 
+        return None
+      api_data = r.json()
 
       # Grab ignored exchanges
-      r = requests.get(self.api_ignored)
+      r = self.http.get(self.api_ignored)
       if r.status_code != 200:
         log.err('[Error]: Status code {} during API pull'.format(
                                                       r.status_code))
-        return False
-      else:
-        self.ignored = r.json()
-
-      # Get supported currencies
-      self.get_currencies()
-
-      # Get supported exchanges
-      self.get_exchanges()
-
-      # Build a parser
-      self.build_parser()
+        return None
 
-      return True
+      return {'all': api_data, 'ignored': r.json()}
     # Connection problems
     except:
       log.err('[Error]: {}'.format(sys.exc_info()[0]))
-      return False
+      return None
+
+  def use_data(self, data):
+    '''
+    Saves the raw API data returned by
+    pull_data along with the currencies
+    and exchanges derived from it.
+
+    All attributes are swapped in at once,
+    so commands never see a partial update.
+    '''
+    currencies = self.get_currencies(data['all'])
+    exchanges = self.get_exchanges(data['all'], currencies)
+
+    self.__dict__.update({ 'api_data': data['all']
+                         , 'ignored': data['ignored']
+                         , 'currencies': currencies
+                         , 'exchanges': exchanges
+                         })
 
-  def get_currencies(self):
+  def get_currencies(self, api_data):
     '''
-    Save all supported currencies
-    in self.currencies
+    Return a set of all supported
+    currencies in api_data.
     '''
-    if not self.currencies:
-      self.currencies = set([str(cur) for cur in \
-                                 self.api_data.keys() if cur != 'timestamp'])
+    return set([str(cur) for cur in api_data.keys() if cur != 'timestamp'])
 
-  def get_exchanges(self):
+  def get_exchanges(self, api_data, currencies):
     '''
-    Save all exchanges in the dict
-    self.exchanges where:
+    Return a dict of all exchanges in
+    api_data where:
 
       k -> currency code
       v -> list of exchanges
     '''
-    if not self.exchanges:
-      for currency in self.currencies:
-        self.exchanges[currency] = self.api_data[currency].keys()
+    return dict((currency, api_data[currency].keys()) \
+                                          for currency in currencies)
 
   #--------------------------------------------#
   #                                            #
@@ -379,12 +404,13 @@ class BitcoinAverage(Plugin):
     else:
       opts = msg.split()
 
-    # Get fresh data
-    if self.stale():
-      if not self.get_fresh_data():
-        log.err('Failed to obtain fresh API average data')
-        return '[Error]: Cannot access bitcoin average API. ' + \
-                                      'Contact bot maintainer.', True
+    # Serve the last good data, which is
+    # refreshed in the background, only
+    # pulling it here if there is none
+    if not self.refresher.ensure():
+      log.err('Failed to obtain fresh API average data')
+      return '[Error]: Cannot access bitcoin average API. ' + \
+                                    'Contact bot maintainer.', True
 
     # Parse the command
     try:
@@ -439,7 +465,8 @@ class BitcoinAverage(Plugin):
       exchanges = [exchg for exchg in plus_exchanges]
       
     # Finally, calculate the average
-    return self.avg(exchanges, args.currency, args.rate, args.type), False
+    avg = self.avg(exchanges, args.currency, args.rate, args.type)
+    return '{}{}'.format(avg, self.refresher.note()), False
 
   def build_parser(self):
     '''
@@ -1,16 +1,14 @@
 # Imports 
 import argparse
 from csv import DictReader
-import datetime
 import itertools
 from operator import itemgetter
 from string import ascii_uppercase
 import sys
 
-import requests
-
 from gilbertgrapesmom import build_help_and_info, CMND_PREFIX
 from pluginbase import Plugin
+from refresher import Refresher
 from twisted.python import log
 
 class ArgParserError(Exception): pass
@@ -52,12 +50,6 @@ class CryptoCoinCharts(Plugin):
     for arg, val in args.iteritems():
       setattr(self, arg, val)
 
-    # Cache the time of the last
-    # update so no more than a 
-    # given number of API calls
-    # occur in a particular time
-    self.last_update = None
-
     # API URLs
     self.max_pairs = 5 # Max pairs to look up at a time with above API
     self.api_pair = 'http://www.cryptocoincharts.info/v2/api/tradingPair/'
@@ -69,15 +61,26 @@ class CryptoCoinCharts(Plugin):
 
     # Initialize containers for API data
     self.coins = {}
+    self.names = set()
     self.pairs = {}
     self.currencies = set()
 
-    # Get fresh data
-    self.get_fresh_data()
-
     # Get a list of currencies
     self.get_currencies()
 
+    # Start from cached data or get fresh data,
+    # then keep it fresh in the background at
+    # most once a minute
+    self.refresher = Refresher( 'CryptoCoinCharts'
+                              , self.pull_data
+                              , self.use_data
+                              , getattr(self, 'refresh_secs', 60)
+                              , getattr(self, 'max_stale_secs', 600)
+                              , cache=self.cache_file('CryptoCoinCharts')
+                              )
+    if not self.refresher.load():
+      self.refresher.ensure()
+
     # Commands supported
     self.cmnds = { 'rate': self.parse_rate
                  }
@@ -98,6 +101,21 @@ class CryptoCoinCharts(Plugin):
     '''
     return self.cmnds
 
+  def refreshers(self):
+    '''
+    Return the refresher for the
+    list of coins.
+    '''
+    return [self.refresher]
+
+  def cache_ttls(self):
+    '''
+    Replies only change with the API
+    data, so cache them until the next
+    refresh
+    '''
+    return {CMND_PREFIX + 'rate': self.refresher.interval}
+
   def parse_command(self, msg):
     '''
     Parses the command and returns
@@ -181,12 +199,13 @@ class CryptoCoinCharts(Plugin):
     else:
       opts = msg.split()
 
-    # Get fresh data if needed
-    if self.stale():
-      if not self.get_fresh_data():
-        log.err('Failed to obtain fresh API average data')
-        return '[Error]: Cannot access CryptoCoinCharts API. ' + \
-                                      'Contact bot maintainer.', True
+    # Serve the last good list of coins,
+    # which is refreshed in the background,
+    # only pulling it here if there is none
+    if not self.refresher.ensure():
+      log.err('Failed to obtain fresh API average data')
+      return '[Error]: Cannot access CryptoCoinCharts API. ' + \
+                                    'Contact bot maintainer.', True
 
     # Parse the command
     try:
@@ -254,11 +273,13 @@ class CryptoCoinCharts(Plugin):
           
     # Set up data for a request
     try:
-      # Make the proper request
+      # Make the proper request, sharing
+      # the response with identical ones
+      # in progress
       if post:
-        r = requests.post(self.api_pairs, data=payload)
+        r = self.http.coalesced('POST', self.api_pairs, data=payload)
       else:
-        r = requests.get('{}{}'.format(self.api_pair, payload))
+        r = self.http.coalesced('GET', '{}{}'.format(self.api_pair, payload))
 
       # Check for valid status code
       if r.status_code != 200:
@@ -356,49 +377,55 @@ class CryptoCoinCharts(Plugin):
     '''
     Return True if API data is stale.
     '''
-    # See if a pull from the API
-    # has never been made
-    if not self.last_update:
-      return True
-
-    return (datetime.datetime.utcnow() - self.last_update).seconds > 60
+    return self.refresher.stale()
 
   def get_fresh_data(self):
     '''
     Grab fresh data from the API and saves
-    it in class attributes.
+    it in class attributes, sharing any grab
+    already in progress.
 
     Returns True if grab was successful
     and False if an error occurred.
     '''
+    return self.refresher.fetch()
+
+  def pull_data(self):
+    '''
+    Return the list of coins with a non-zero
+    volume from the API, or None if an error
+    occurred.
+    '''
     try:
       # Now, grab the pairs data
-      r = requests.get(self.api_list_coins)
+      r = self.http.get(self.api_list_coins)
       if r.status_code != 200:
         log.err('[Error]: Status code {} for listing coins'.\
                     format(r.status_code))
-        return False
-      else:
-        self.coins = {}
-        for coind in r.json():
-          # Don't take any coins with zero volume
-          if not float(coind['volume_btc']):
-            continue
-          # Otherwise, save the information
-          self.coins[coind['id']] = {k: v for k,v in coind.iteritems() \
-                                                  if k != 'id'}
-
-        # Also save a list of coin names
-        self.names = {str(x.upper()) for x in self.coins.iterkeys()}
-
-        # Finally, get some currencies
-        self.get_currencies()
-
-        return True
+        return None
+
+      # Don't take any coins with zero volume
+      return [coind for coind in r.json() if float(coind['volume_btc'])]
     # Any error that occurs connecting to the API    
     except:
       log.err('[Error]: {}'.format(sys.exc_info()[0]))
-      return False
+      return None
+
+  def use_data(self, data):
+    '''
+    Save the list of coins returned by
+    pull_data in class attributes, which
+    are swapped in at once.
+    '''
+    coins = {}
+    for coind in data:
+      coins[coind['id']] = {k: v for k,v in coind.iteritems() \
+                                              if k != 'id'}
+
+    # Also save a list of coin names
+    names = {str(x.upper()) for x in coins.iterkeys()}
+
+    self.__dict__.update({'coins': coins, 'names': names})
 
   def get_currencies(self):
     '''
@@ -1,15 +1,21 @@
 # Imports
 import argparse
+import difflib
+import math
 from operator import itemgetter
+import re
 import shlex
 import sqlite3 as lite
 import sys
-
-import requests
+import threading
+import time
 
 from areacodes import areacodes
+from citystore import COLUMNS, CityStore
 from gilbertgrapesmom import build_help_and_info, CMND_PREFIX
 from pluginbase import Plugin
+from refresher import Refresher
+from ttlcache import MISS, TTLCache
 from twisted.python import log
 
 class ArgParserError(Exception): pass
@@ -45,61 +51,524 @@ class EvenAndMinMaxPairs(argparse.Action):
 
     setattr(args, self.dest, values)
 
+# Mean radius of the Earth
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+def haversine(lat1, lon1, lat2, lon2):
+  '''
+  Return the great circle distance in km
+  between two points given in degrees.
+  '''
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  a = math.sin((lat2 - lat1) / 2) ** 2 + \
+      math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+  return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def distances(lat, lon, points):
+  '''
+  Return a list of the great circle
+  distances in km from lat, lon to each
+  (lat, lon) 2-tuple of points, converting
+  the origin once for all of them.
+  '''
+  lat, lon = math.radians(lat), math.radians(lon)
+  cos_lat = math.cos(lat)
+  sin, cos, asin, sqrt, radians = \
+                      math.sin, math.cos, math.asin, math.sqrt, math.radians
+  kms = []
+  for plat, plon in points:
+    plat, plon = radians(plat), radians(plon)
+    a = sin((plat - lat) / 2) ** 2 + \
+        cos_lat * cos(plat) * sin((plon - lon) / 2) ** 2
+    kms.append(2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a))))
+  return kms
+
+def distance_matrix(points):
+  '''
+  Return the matrix, as a list of lists,
+  of the great circle distances in km
+  between every two (lat, lon) 2-tuples
+  of points, converting each point once
+  and computing each pair once.
+  '''
+  rads = [(math.radians(lat), math.radians(lon)) for lat, lon in points]
+  coss = [math.cos(lat) for lat, _ in rads]
+  matrix = [[0.0] * len(points) for _ in points]
+  for i, (lat1, lon1) in enumerate(rads):
+    for j in range(i + 1, len(rads)):
+      lat2, lon2 = rads[j]
+      a = math.sin((lat2 - lat1) / 2) ** 2 + \
+          coss[i] * coss[j] * math.sin((lon2 - lon1) / 2) ** 2
+      matrix[i][j] = matrix[j][i] = \
+                  2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+  return matrix
+
+def bearing(lat1, lon1, lat2, lon2):
+  '''
+  Return the initial bearing in degrees,
+  clockwise from north, of the great circle
+  from the first point to the second.
+  '''
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  y = math.sin(lon2 - lon1) * math.cos(lat2)
+  x = math.cos(lat1) * math.sin(lat2) - \
+      math.sin(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+  return math.degrees(math.atan2(y, x)) % 360
+
+def compass(degrees):
+  '''
+  Return the compass point, e.g., NW,
+  nearest a bearing in degrees.
+  '''
+  return ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW'][
+                                        int((degrees + 22.5) // 45) % 8]
+
 class CitiesDB(object):
-  def __init__(self, cities_db_fname, cities_db_table):
+  # Indexes query_city needs to avoid a full
+  # table scan, built by cities_db_2_sqlite.py,
+  # where
+  #   k -> index name
+  #   v -> indexed columns
+  INDEXES = { 'cities_asciiname_population':
+                  ('asciiname', 'population DESC')
+            , 'cities_asciiname_iso_population':
+                  ('asciiname', 'iso', 'population DESC')
+            }
+
+  # Least similarity of a misspelled
+  # name to the closest known name
+  MIN_SIMILARITY = 0.75
+
+  # Told when a name matching no place
+  # cannot be searched for
+  NO_SEARCH = 'name search is unavailable'
+
+  # Window functions rank the rows of each
+  # name in one query from SQLite 3.25.0
+  WINDOWS = lite.sqlite_version_info >= (3, 25, 0)
+
+  def __init__( self, cities_db_fname, cities_db_table
+              , cache_size=256, cache_ttl=3600):
     # Save basic DB information
     self.db = cities_db_fname
     self.table = cities_db_table
 
+    # Recent replies where
+    #   k -> (name, limit, columns, country code)
+    #   v -> reply
+    self.replies = TTLCache(cache_size)
+    self.cache_ttl = cache_ttl
+
+    # Text of the lookup statements where
+    #   k -> (names, limit, columns, country code?)
+    #   v -> SQL
+    # so the same text is run each time and
+    # its prepared statement reused from the
+    # statement cache of the connection
+    self.statements = {}
+
+    # Full text search tables built by
+    # cities_db_2_sqlite.py for names which
+    # match no city exactly where
+    #   search -> FTS5 over the names and
+    #             alternate names of every
+    #             populated place by gid
+    #   vocab -> FTS5 trigrams of distinct
+    #            names for misspellings
+    self.search_table = self.table + '_search'
+    self.vocab_table = self.table + '_vocab'
+
+    # R*Tree of the coordinates of every
+    # populated place by gid for ?near
+    self.rtree_table = self.table + '_rtree'
+
+    # Commands run in worker threads and
+    # SQLite connections cannot be shared
+    # between threads, so each thread
+    # gets its own connection
+    self.local = threading.local()
+
     # Create a database connection
     self.connected = False
     self.make_connection()
+    self.check_indexes()
+    self.searchable = self.has_tables(self.search_table, self.vocab_table)
+    self.spatial = self.has_tables(self.rtree_table)
 
   def make_connection(self):
-    if not self.connected:
-      self.con = lite.connect(self.db)
+    '''
+    Connect to the database in the calling
+    thread unless already connected.
+
+    Return True if a connection was made.
+    '''
+    if getattr(self.local, 'con', None) is None:
+      self.local.con = lite.connect(self.db)
+      self.local.con.row_factory = lite.Row
       self.connected = True
-      return self.connected
+      return True
     return False
 
-  def query_city(self, asciiname, limit, **kwargs):
-    # Make a connection if needed
-    if not self.connected:
-      self.make_connection()
-
-    # Query the database based on 
-    # which arguments were passed in
-    self.con.row_factory = lite.Row
+  @property
+  def con(self):
+    self.make_connection()
+    return self.local.con
 
-    # Get a dictionary cursor 
+  def missing_indexes(self):
+    '''
+    Return a list of the names of the
+    indexes in INDEXES the table lacks.
+    '''
     cur = self.con.cursor()
+    cur.execute('PRAGMA index_list({})'.format(self.table))
+    names = [row[1] for row in cur.fetchall()]
+
+    # Compare the indexed columns as any
+    # name will do
+    indexed = set()
+    for name in names:
+      cur.execute('PRAGMA index_info({})'.format(name))
+      indexed.add(tuple(row[2] for row in cur.fetchall()))
+
+    return [ name for name, cols in sorted(self.INDEXES.items()) \
+                if tuple(col.split()[0] for col in cols) not in indexed ]
+
+  def check_indexes(self):
+    '''
+    Report any index missing from the
+    table, as every query on it is then
+    a full table scan.
+
+    Return True if none are missing.
+    '''
+    missing = self.missing_indexes()
+    if missing:
+      log.err('[Error]: {} in {} lacks indexes {}, so ?city scans the '
+              'whole table. Rebuild it with cities_db_2_sqlite.py'.format(
+                                        self.table, self.db, ', '.join(missing)))
+    return not missing
+
+  def create_indexes(self):
+    '''
+    Create the indexes in INDEXES and
+    update the query planner statistics.
+    '''
+    with self.con:
+      for name, cols in sorted(self.INDEXES.items()):
+        self.con.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                                          name, self.table, ', '.join(cols)))
+      self.con.execute('ANALYZE {}'.format(self.table))
 
-    # Perform a SELECT statement
+  def has_tables(self, *names):
+    '''
+    Return True if the tables, e.g., those
+    of the full text search, were built.
+    '''
+    cur = self.con.execute(
+        'SELECT COUNT(*) FROM sqlite_master WHERE name IN ({})'.format(
+                                                  ','.join('?' * len(names))),
+        names)
+    return cur.fetchone()[0] == len(names)
+
+  def query_city(self, asciiname, limit, **kwargs):
+    '''
+    Return a reply about the most populous
+    places called asciiname, or whose names
+    or alternate names start with its words,
+    or, failing that, about the places with
+    the closest name.
+    '''
+    return self.query_cities([asciiname], limit, **kwargs)[0]
+
+  def query_cities(self, asciinames, limit, **kwargs):
+    '''
+    Return a list of replies, as query_city's,
+    about each of asciinames, looking up all
+    those not recently asked about at once.
+    '''
+    # Columns to show and any country code
     col_names = sorted([col_name for col_name in kwargs.iterkeys()])
-    have_cc = not (type(kwargs['iso']) == bool)
+    iso = kwargs['iso'] if not (type(kwargs.get('iso', True)) == bool) \
+                        else None
+
+    keys = [(name, int(limit), tuple(col_names), iso) for name in asciinames]
+    replies = dict((key, self.replies.get(key)) for key in set(keys))
+
+    wanted = [key[0] for key, reply in replies.iteritems() if reply is MISS]
+    if wanted:
+      found = self.exact(wanted, limit, col_names, iso)
+      for name in wanted:
+        key = (name, int(limit), tuple(col_names), iso)
+        replies[key] = self.reply(name, found[name], limit, col_names, iso)
+        self.replies.put(key, replies[key], self.cache_ttl)
+
+    return [replies[key] for key in keys]
+
+  def reply(self, asciiname, rows, limit, col_names, iso=None):
+    '''
+    Return the reply about asciiname given
+    the rows of the places called so,
+    searching for others if there are none,
+    and saying so if none are found either.
+    '''
+    about = name = asciiname
+    if not rows and not self.searchable:
+      about = '{} (no exact match, and {})'.format(asciiname, self.NO_SEARCH)
+    elif not rows:
+      rows = self.prefix_search(asciiname, limit, col_names, iso)
+      if not rows:
+        closest = self.closest_name(asciiname)
+        if closest and closest != asciiname:
+          about = '{} (closest to "{}")'.format(closest, asciiname)
+          name = closest
+          rows = self.exact([name], limit, col_names, iso)[name]
+
+    if not rows:
+      return '[About {}]: No such place found'.format(about)
+    return self.format_rows(about, name, rows, col_names)
+
+  def exact(self, asciinames, limit, col_names, iso=None):
+    '''
+    Return a dictionary of the rows of the
+    places called each of asciinames, most
+    populous first, from one query.
+    '''
+    names = sorted(set(asciinames))
+    key = (len(names), int(limit), tuple(col_names), bool(iso))
+    if key not in self.statements:
+      self.statements[key] = self.exact_sql(*key)
+
+    params = dict(('n{}'.format(i), name.decode('utf-8', 'replace')) \
+                      for i, name in enumerate(names))
+    params['iso'] = iso
+
+    found = dict((name.decode('utf-8', 'replace'), []) for name in names)
+    for row in self.con.execute(self.statements[key], params):
+      found[row['matched']].append(row)
+    return dict((name, found[name.decode('utf-8', 'replace')]) \
+                    for name in names)
+
+  def exact_sql(self, num_names, limit, col_names, have_cc):
+    '''
+    Return the SQL selecting the limit most
+    populous places for each of num_names
+    names, bound as :n0, :n1, ..., and
+    any country code, bound as :iso.
+    '''
+    and_clause = 'AND iso=:iso' if have_cc else ''
+    if self.WINDOWS:
+      return '''
+         SELECT * FROM (
+           SELECT {col_names}, asciiname AS matched,
+                  ROW_NUMBER() OVER (PARTITION BY asciiname
+                                     ORDER BY population DESC) AS place
+           FROM {table}
+           WHERE asciiname IN ({names})
+           AND population > 0
+           {and_clause}
+         )
+         WHERE place <= {limit}
+         ORDER BY matched, place
+      '''.format( col_names=','.join(col_names)
+                , table=self.table
+                , names=','.join(':n{}'.format(i) for i in range(num_names))
+                , and_clause=and_clause
+                , limit=int(limit)
+                )
+
+    # Otherwise a query per name, sent
+    # together as one compound statement
+    return ' UNION ALL '.join('''
+         SELECT * FROM (
+           SELECT {col_names}, asciiname AS matched
+           FROM {table}
+           WHERE asciiname=:n{i}
+           AND population > 0
+           {and_clause}
+           ORDER BY population DESC
+           LIMIT {limit}
+         )'''.format( col_names=','.join(col_names)
+                    , table=self.table
+                    , i=i
+                    , and_clause=and_clause
+                    , limit=int(limit)
+                    ) for i in range(num_names))
+
+  def prefix_search(self, query, limit, col_names, iso=None):
+    '''
+    Return rows of the places with names or
+    alternate names starting with each word
+    of query, most populous first.
+    '''
+    words = [w for w in re.findall(r'\w+', query.decode('utf-8', 'replace'),
+                                   re.U) if len(w) > 1]
+    if not words:
+      return []
+
     sql = '''
-       SELECT {col_names} 
-       FROM {table}
-       WHERE asciiname=?
-       AND population > 0
+       SELECT {col_names}, c.asciiname AS matched
+       FROM {search} s JOIN {table} c ON c.gid = s.rowid
+       WHERE {search} MATCH ?
+       AND c.population > 0
        {and_clause}
-       ORDER BY population DESC
+       ORDER BY c.population DESC
        LIMIT {limit}
-    '''.format( col_names=','.join(col_names)
+    '''.format( col_names=','.join('c.' + col for col in col_names)
+              , search=self.search_table
               , table=self.table
-              , and_clause='AND iso=?' if have_cc else ''
+              , and_clause='AND c.iso=?' if iso else ''
               , limit=int(limit)
               )
+    match = ' '.join(u'"{}"*'.format(w) for w in words)
+    return self.con.execute(sql, (match, iso) if iso else (match,)).fetchall()
+
+  def closest_name(self, query):
+    '''
+    Return the known name most similar to
+    a misspelled query, preferring the more
+    populous, or None if none is close.
+    '''
+    query = query.decode('utf-8', 'replace').replace('"', '').strip()
+    trigrams = set(query[i:i + 3].lower() for i in range(len(query) - 2))
+    if not trigrams:
+      return None
 
-    # Get the results and return a reply
-    cur.execute(sql, (asciiname,) if not have_cc \
-                                  else (asciiname, kwargs['iso']))
-    rows = cur.fetchall()
+    # Names sharing the most trigrams
+    sql = '''
+       SELECT name, population
+       FROM {vocab}
+       WHERE {vocab} MATCH ?
+       ORDER BY rank
+       LIMIT 50
+    '''.format(vocab=self.vocab_table)
+    match = u' OR '.join(u'"{}"'.format(t) for t in sorted(trigrams))
+    candidates = self.con.execute(sql, (match,)).fetchall()
+
+    # Then the most similar of them
+    best = None
+    for name, population in candidates:
+      ratio = difflib.SequenceMatcher(None, query.lower(), name.lower()).ratio()
+      if ratio >= self.MIN_SIMILARITY and \
+          (best is None or (ratio, population) > best[:2]):
+        best = (ratio, population, name)
+    return best[2].encode('utf-8') if best else None
+
+  def nearest(self, lat, lon, n, min_population=1):
+    '''
+    Return a list of up to n (km, row)
+    2-tuples of the places of at least
+    min_population nearest lat, lon,
+    nearest first, whose rows have their
+    asciiname, iso, population, latitude
+    and longitude.
+    '''
+    # Search ever larger boxes around the
+    # point until n places are closer than
+    # anything outside the box could be
+    reach = 0.25
+    while True:
+      rows = self.in_box(lat, lon, reach, min_population)
+      found = zip(distances(lat, lon, [(row['latitude'], row['longitude']) \
+                                          for row in rows]), rows)
+      found.sort(key=itemgetter(0))
+      near = [km for km, _ in found if km <= reach * KM_PER_DEGREE]
+      if len(near) >= n or reach >= 180:
+        return found[:n]
+      reach *= 2
+
+  def within(self, lat, lon, km, n, min_population=1):
+    '''
+    Return a list of up to n (km, row)
+    2-tuples, as nearest's, of the most
+    populous places of at least min_population
+    within km of lat, lon, most populous first.
+    '''
+    # Only places in the box around the
+    # circle can be in it
+    rows = self.in_box(lat, lon, km / KM_PER_DEGREE, min_population)
+    found = [ (d, row) for d, row in \
+                zip(distances(lat, lon, [(row['latitude'], row['longitude']) \
+                                            for row in rows]), rows) \
+                if d <= km ]
+    found.sort(key=lambda (d, row): row['population'], reverse=True)
+    return found[:n]
+
+  def locate(self, asciinames):
+    '''
+    Return a dictionary of the row, of its
+    iso, latitude, longitude, population
+    and matched name, of the most populous
+    place called, or else found by searching
+    for, each of asciinames, or None.
+    '''
+    col_names = ['iso', 'latitude', 'longitude', 'population']
+    found = self.exact(asciinames, 1, col_names)
+    for name, rows in found.items():
+      if not rows and self.searchable:
+        rows = self.prefix_search(name, 1, col_names)
+        if not rows:
+          closest = self.closest_name(name)
+          if closest:
+            rows = self.exact([closest], 1, col_names)[closest]
+      found[name] = rows[0] if rows else None
+    return found
+
+  def in_box(self, lat, lon, reach, min_population=1):
+    '''
+    Return rows of the places of at least
+    min_population in the box around lat,
+    lon reaching reach degrees of latitude,
+    and at least as far in longitude, from it.
+    '''
+    # Degrees of longitude spanning reach
+    # degrees of latitude at the poleward
+    # edge of the box, if short of the pole
+    edge = abs(lat) + reach
+    span = reach / math.cos(math.radians(edge)) if edge < 89.9 else 360
+
+    # Boxes crossing the antimeridian
+    # are split in two
+    if span >= 180:
+      lons = [(-180, 180)]
+    elif lon - span < -180:
+      lons = [(lon - span + 360, 180), (-180, lon + span)]
+    elif lon + span > 180:
+      lons = [(lon - span, 180), (-180, lon + span - 360)]
+    else:
+      lons = [(lon - span, lon + span)]
 
-    preface = '[About {}]:\n'.format(asciiname)
+    sql = '''
+       SELECT c.asciiname, c.iso, c.population, c.latitude, c.longitude
+       FROM {rtree} t JOIN {table} c ON c.gid = t.gid
+       WHERE t.min_lat <= :max_lat AND t.max_lat >= :min_lat
+       AND t.min_lon <= :max_lon AND t.max_lon >= :min_lon
+       AND t.population >= :min_population
+    '''.format(rtree=self.rtree_table, table=self.table)
+
+    rows = []
+    for min_lon, max_lon in lons:
+      rows.extend(self.con.execute(sql, { 'min_lat': lat - reach
+                                        , 'max_lat': lat + reach
+                                        , 'min_lon': min_lon
+                                        , 'max_lon': max_lon
+                                        , 'min_population': min_population
+                                        }))
+    return rows
+
+  def format_rows(self, about, asciiname, rows, col_names):
+    '''
+    Return the reply listing col_names of
+    each row, naming places called other
+    than asciiname.
+    '''
+    preface = '[About {}]:\n'.format(about)
     replies = []
     for row in rows:
       vals = []
+      matched = row['matched'] or u''
+      if matched.lower() != asciiname.decode('utf-8', 'replace').lower():
+        vals.append('Name: {}'.format(matched.encode('utf-8')))
       for col_name in col_names:
         if col_name == 'population':
           vals.append('{}: {:,}'.format(col_name.title(), 
@@ -112,15 +581,100 @@ class CitiesDB(object):
 
     return preface + '\n'.join(replies)
 
+class MappedCitiesDB(CitiesDB):
+  '''
+  MappedCitiesDB answers exact names from
+  a city store written by cities_db_2_sqlite.py
+  --store, shared by every process mapping
+  it, instead of from SQLite.
+
+  The store only has the columns in
+  citystore.COLUMNS. Names matching no
+  place, ?near and ?distance -w still use
+  the search tables and R*Tree of the
+  SQLite database alongside it, if any.
+
+  Once the store is replaced, e.g., after
+  daily updates, it is mapped again and
+  the cached replies dropped.
+  '''
+  # Seconds between checks for a new store
+  CHECK_SECS = 1.0
+
+  def __init__( self, store_fname, cities_db_fname, cities_db_table
+              , cache_size=256, cache_ttl=3600):
+    self.store_fname = store_fname
+    self.store = CityStore(store_fname)
+    self.checked = time.time()
+    self.store_lock = threading.Lock()
+    super(MappedCitiesDB, self).__init__( cities_db_fname, cities_db_table
+                                        , cache_size, cache_ttl)
+
+  def check_indexes(self):
+    # Exact names are looked up in the
+    # store, so SQLite needs no indexes
+    return True
+
+  def current_store(self):
+    '''
+    Return the city store, mapping it again
+    if it was replaced since last checked.
+    '''
+    now = time.time()
+    if now - self.checked >= self.CHECK_SECS:
+      with self.store_lock:
+        self.checked = now
+        if self.store.replaced():
+          # Readers of the old store keep it
+          # mapped until they are done
+          self.store = CityStore(self.store_fname)
+          self.replies = TTLCache(self.replies.size)
+    return self.store
+
+  def query_cities(self, asciinames, limit, **kwargs):
+    unknown = sorted(set(kwargs) - set(COLUMNS))
+    if unknown:
+      return ['The city store lacks {}'.format(', '.join(unknown))]
+
+    # Before answering from cached replies
+    # of a store since replaced
+    self.current_store()
+    return super(MappedCitiesDB, self).query_cities(asciinames, limit, **kwargs)
+
+  def exact(self, asciinames, limit, col_names, iso=None):
+    store = self.current_store()
+    found = {}
+    for name in set(asciinames):
+      matched = name.decode('utf-8', 'replace')
+      rows = []
+      for record in store.records(matched.encode('utf-8')):
+        if len(rows) >= int(limit):
+          break
+        row = dict(zip(COLUMNS, record))
+        if not iso or row['iso'] == iso:
+          row['matched'] = matched
+          rows.append(row)
+      found[name] = rows
+    return found
+
 class Lookup(Plugin):
   def __init__(self, args):
     # Save the arguments
     for arg, val in args.iteritems():
       setattr(self, arg, val)
 
-    # For the cities database
-    self.cdb = CitiesDB(self.cities_db, self.cities_db_table)
+    # For the cities database, in SQLite
+    # or a city store mapped into memory
+    if getattr(self, 'cities_backend', 'sqlite') == 'mmap':
+      self.cdb = MappedCitiesDB( self.cities_store
+                               , self.cities_db, self.cities_db_table
+                               , int(getattr(self, 'cities_cache_size', 256)))
+    else:
+      self.cdb = CitiesDB( self.cities_db, self.cities_db_table
+                         , int(getattr(self, 'cities_cache_size', 256)))
     self.build_city_parser()
+    self.build_near_parser()
+    self.build_distance_parser()
 
     # For accurate forex data
     self.FOREX_LATEST = 'http://openexchangerates.org/api/latest.json?app_id={}'
@@ -129,19 +683,37 @@ class Lookup(Plugin):
     self.FOREX_LATEST_URL = self.FOREX_LATEST.format(self.FOREX_API_KEY)
     self.FOREX_CS_URL = self.FOREX_CS.format(self.FOREX_API_KEY)
     self.forex_updates_secs = int(self.forex_update_secs) * 60
-    self.forex_last_get = None
-    self.forex_cs = []  # List of forex currencies
+    self.forex_cs = {}  # Forex currency codes to long names
+    self.forex_rates = {}
     self.build_forex_parser() # Create an argparse instance for forex queries
 
-    # For GeoIP lookups
+    # Start from cached forex data, if any, and
+    # keep it fresh in the background, otherwise
+    # pulling it on first use
+    self.forex_refresher = Refresher( 'forex'
+                                    , self.forex_pull_data
+                                    , self.forex_use_data
+                                    , self.forex_updates_secs
+                                    , getattr( self, 'forex_max_stale_secs'
+                                             , 4 * self.forex_updates_secs)
+                                    , cache=self.cache_file('forex')
+                                    )
+    self.forex_refresher.load()
+
+    # For GeoIP lookups, which name the
+    # nearest city of at least this many
     self.GEOIP_API = 'https://freegeoip.net/json/{}'
+    self.geoip_near_population = int(getattr( self, 'geoip_near_population'
+                                            , 100000))
 
     # Supported commands
     self.cmnds = { 'areacode': self.areacode
                  , 'ac':  self.areacode
                  , 'city': self.city
+                 , 'distance': self.distance
                  , 'forex': self.forex
                  , 'geoip': self.geoip 
+                 , 'near': self.near
                  }
     self.cmnds = dict((CMND_PREFIX + k, v) for k, v in self.cmnds.items())
 
@@ -151,6 +723,19 @@ class Lookup(Plugin):
   def get_commands(self):
     return self.cmnds
 
+  def refreshers(self):
+    return [self.forex_refresher]
+
+  def cache_ttls(self):
+    return { CMND_PREFIX + 'areacode': 86400
+           , CMND_PREFIX + 'ac': 86400
+           , CMND_PREFIX + 'city': 3600
+           , CMND_PREFIX + 'distance': 3600
+           , CMND_PREFIX + 'forex': self.forex_updates_secs
+           , CMND_PREFIX + 'geoip': 3600
+           , CMND_PREFIX + 'near': 3600
+           }
+
   def parse_command(self, msg):
     # Call the super class
     parse_ret = super(Lookup, self).parse_command(msg)
@@ -184,6 +769,13 @@ class Lookup(Plugin):
       reply.append(' | Use ' + CMND_PREFIX + 'info for more details.')
       return ' '.join(reply), False
 
+    elif msg.startswith('distance'):
+      reply = self.distance_parser.format_usage().rstrip()
+      reply = reply.split()
+      reply[1] = CMND_PREFIX + 'distance'
+      reply.append(' | Use ' + CMND_PREFIX + 'info for more details.')
+      return ' '.join(reply), False
+
     elif msg.startswith('forex'):
       reply = self.forex_parser.format_usage().rstrip()
       reply = reply.split()
@@ -196,6 +788,13 @@ class Lookup(Plugin):
               CMND_PREFIX + 'info geoip for more extensive info.'
       return reply, False
 
+    elif msg.startswith('near'):
+      reply = self.near_parser.format_usage().rstrip()
+      reply = reply.split()
+      reply[1] = CMND_PREFIX + 'near'
+      reply.append(' | Use ' + CMND_PREFIX + 'info for more details.')
+      return ' '.join(reply), False
+
     elif msg.startswith('timezone'):
       reply = 'Returns the timezone(s) for a space delimited ' + \
           'list of cities'
@@ -204,7 +803,8 @@ class Lookup(Plugin):
   def info(self, msg):
     # Strip prefix for aliased commands
     # and the help command removed
-    msg = msg.lstrip(CMND_PREFIX + 'info')
+    if msg.startswith(CMND_PREFIX + 'info'):
+      msg = msg[len(CMND_PREFIX + 'info'):].lstrip()
 
     if msg.startswith('city'):
       reply = '''
@@ -250,9 +850,37 @@ class Lookup(Plugin):
 
         All supported arguments of this type are:
 
-          --country-code  
+          --country-code
+
+        A name matching no city exactly is searched for
+        as the start of the words of city names and their
+        alternate names, e.g., "san fran" or "Cologne", and
+        failing that as a misspelling of the closest city
+        name, e.g., "Pittsburg", most populous first.
       '''
       return reply, True
+    elif msg.startswith('distance'):
+      reply = '''
+        Places are from the same GeoNames database as
+        the city command, taking the most populous place
+        of each name.
+
+        Given two city names, with any whitespace in the
+        name(s) included in double quotes, the command
+        returns the great circle distance between them and
+        the initial bearing from the first to the second.
+
+        Given more, it returns the distances in km between
+        every two of them.
+
+        With -w KM, it instead takes one city name and
+        returns the most populous places within KM km
+        of it, e.g.,
+
+          distance -w 50 Paris
+      '''
+      return reply, True
+
     elif msg.startswith('forex'):
       reply = '''
         Forex data obtained from openexchangerates.org.
@@ -277,7 +905,30 @@ class Lookup(Plugin):
       reply = '''
       GeoIP data is obtained from freegeoip.net, which is
       based on the MaxMind and ipinfo.db databases primarily.
+
+      The nearest city in the GeoNames database is added
+      when it has a spatial index.
+      '''
+      return reply, True
+
+    elif msg.startswith('near'):
+      reply = '''
+        Places are from the same GeoNames database as
+        the city command.
+
+        The command takes a latitude and a longitude in
+        decimal degrees, south and west being negative,
+        and returns the nearest populated places with their:
+
+          - ISO-3166 Country code
+          - Population
+          - Distance in km
+
+        The number of places is given with -n, e.g.,
+
+          near 48.8566 2.3522 -n 3
       '''
+      return reply, True
 
     ni = 'Not available for that command. Use help instead.'
     return ni, False
@@ -341,19 +992,18 @@ class Lookup(Plugin):
                    if v and k != 'cities'}
 
     # Check if a country code is specified
-    if not type(kwargs['iso']) == bool:
-      defaults['iso'] = kwargs['iso']
-      del kwargs['iso']
+    iso = kwargs.pop('iso', None)
 
     # See if we have the default or not
     if not kwargs:
       kwargs = defaults
 
-    # Get data about the city passed in
-    replies = []
-    for city in cities:
-      reply = self.cdb.query_city(city, self.cities_select_limit, **kwargs)
-      replies.append(reply)
+    # Filter on any country code
+    if iso:
+      kwargs['iso'] = iso
+
+    # Get data about the cities passed in
+    replies = self.cdb.query_cities(cities, self.cities_select_limit, **kwargs)
 
     # Return the information
     return '\n'.join(replies), \
@@ -418,12 +1068,173 @@ class Lookup(Plugin):
                                  , metavar='ASCII_CITY_NAME'
                                  )
 
+  def near(self, msg):
+    # Treat the non-command part of msg
+    # as the portion to be parsed
+    if msg.startswith(CMND_PREFIX + 'near'):
+      opts = msg.split()[1:]
+    else:
+      opts = msg.split()
+
+    try:
+      # Parse the command
+      args = self.near_parser.parse_args(opts)
+    except ArgParserError, exc:
+      return exc, True
+
+    if not self.cdb.spatial:
+      return '[Error]: The cities database lacks a spatial index. ' + \
+             'Please contact bot maintainer.', True
+    if not (-90 <= args.latitude <= 90 and -180 <= args.longitude <= 180):
+      return 'Latitude must be within [-90, 90] and longitude ' + \
+             'within [-180, 180]', False
+    if not 0 < args.number <= self.max_near:
+      return 'Can only ask for 1 to {} places'.format(self.max_near), False
+
+    # Get the places nearest the point
+    preface = '[Near {}, {}]:\n'.format(args.latitude, args.longitude)
+    replies = []
+    for km, row in self.cdb.nearest(args.latitude, args.longitude, args.number):
+      replies.append('\t' + ' | '.join([
+                        'Name: {}'.format(row['asciiname'].encode('utf-8'))
+                      , 'Country Code: {}'.format(row['iso'])
+                      , 'Population: {:,}'.format(int(row['population']))
+                      , 'Distance: {:,.1f} km'.format(km)
+                      ]))
+
+    # Return the information
+    return preface + '\n'.join(replies), len(replies) > 1
+
+  def build_near_parser(self):
+    # Most places given by ?near and ?distance
+    self.max_near = 2 * int(self.cities_select_limit)
+
+    # Build a parser object
+    self.near_parser = ArgParser( description='Find the places nearest a point'
+                                , add_help=False
+                                )
+
+    # Add supported arguments
+    self.near_parser.add_argument( '-n'
+                                 , '--number'
+                                 , type=int
+                                 , default=int(self.cities_select_limit)
+                                 )
+    self.near_parser.add_argument( 'latitude'
+                                 , type=float
+                                 )
+    self.near_parser.add_argument( 'longitude'
+                                 , type=float
+                                 )
+
+  def distance(self, msg):
+    # Treat the non-command part of msg
+    # as the portion to be parsed
+    if msg.startswith(CMND_PREFIX + 'distance'):
+      opts = msg.split()[1:]
+    else:
+      opts = msg.split()
+
+    try:
+      # Parse the command
+      args = self.distance_parser.parse_args(opts)
+      cities = shlex.split(' '.join(args.cities))
+    except (ArgParserError, ValueError), exc:
+      return exc, True
+
+    if args.within is not None:
+      if len(cities) != 1:
+        return 'Can only find places within a distance of one city', False
+      if not self.cdb.spatial:
+        return '[Error]: The cities database lacks a spatial index. ' + \
+               'Please contact bot maintainer.', True
+      if not 0 < args.within <= self.max_within_km:
+        return 'Can only find places within 0 to {:,} km'.format(
+                                                  self.max_within_km), False
+    elif not 2 <= len(cities) <= self.max_near:
+      return 'Can only give the distances between 2 to {} cities'.format(
+                                                      self.max_near), False
+
+    # Find where each city is
+    found = self.cdb.locate(cities)
+    missing = [city for city in cities if found[city] is None]
+    if missing:
+      return 'Cannot find {}{}'.format(', '.join(missing),
+               '' if self.cdb.searchable else \
+                  ' ({})'.format(self.cdb.NO_SEARCH)), False
+    places = [found[city] for city in cities]
+    names = ['{}, {}'.format(row['matched'].encode('utf-8'), row['iso']) \
+                for row in places]
+
+    if args.within is not None:
+      return self.places_within(names[0], places[0], args.within)
+
+    if len(places) == 2:
+      a, b = places
+      km = distances(a['latitude'], a['longitude'],
+                     [(b['latitude'], b['longitude'])])[0]
+      deg = bearing(a['latitude'], a['longitude'],
+                    b['latitude'], b['longitude'])
+      return '[{} -> {}]: {:,.1f} km, bearing {:.0f} ({})'.format(
+                              names[0], names[1], km, deg, compass(deg)), False
+
+    # The distances between every two
+    matrix = distance_matrix([(row['latitude'], row['longitude']) \
+                                for row in places])
+    replies = []
+    for i, name in enumerate(names):
+      replies.append('\t{}: '.format(name) + ' | '.join(
+          '{} {:,.0f}'.format(names[j].split(',')[0], km) \
+              for j, km in enumerate(matrix[i]) if j != i))
+    return '[Distances in km]:\n' + '\n'.join(replies), True
+
+  def places_within(self, name, place, km):
+    '''
+    Return a reply of the most populous
+    places within km of place, called name.
+    '''
+    preface = '[Within {:,g} km of {}]:\n'.format(km, name)
+    replies = []
+    for d, row in self.cdb.within( place['latitude'], place['longitude']
+                                 , km, self.max_near + 1):
+      # Skip the city itself
+      if d == 0 and row['asciiname'] == place['matched']:
+        continue
+      replies.append('\t' + ' | '.join([
+                        'Name: {}'.format(row['asciiname'].encode('utf-8'))
+                      , 'Country Code: {}'.format(row['iso'])
+                      , 'Population: {:,}'.format(int(row['population']))
+                      , 'Distance: {:,.1f} km'.format(d)
+                      ]))
+    return preface + '\n'.join(replies[:self.max_near]), len(replies) > 1
+
+  def build_distance_parser(self):
+    # Largest radius given by ?distance -w
+    self.max_within_km = 1000
+
+    # Build a parser object
+    self.distance_parser = ArgParser( description='Find distances between cities'
+                                    , add_help=False
+                                    )
+
+    # Add supported arguments
+    self.distance_parser.add_argument( '-w'
+                                     , '--within'
+                                     , type=float
+                                     , metavar='KM'
+                                     )
+    self.distance_parser.add_argument( 'cities'
+                                     , nargs='+'
+                                     , metavar='ASCII_CITY_NAME'
+                                     )
+
   def forex(self, msg):
-    # See if we need to get new data
-    if self.forex_data_stale():
-      if not self.forex_get_fresh_data():
-        reply = 'Cannot obtain fresh forex API data. ' + \
-            'Please contact bot maintainer.', True
+    # Serve the last good data, which is
+    # refreshed in the background, only
+    # pulling it here if there is none
+    if not self.forex_refresher.ensure():
+      return '[Error]: Cannot obtain fresh forex API data. ' + \
+          'Please contact bot maintainer.', True
 
     # Break out the options
     if msg.startswith(CMND_PREFIX + 'forex'):
@@ -487,7 +1298,7 @@ class Lookup(Plugin):
 
       replies.append(reply)
 
-    return ' | '.join(replies), False
+    return ' | '.join(replies) + self.forex_refresher.note(), False
 
   def long_name(self, cur):
     '''
@@ -547,37 +1358,47 @@ class Lookup(Plugin):
     data from the forex API. False 
     otherwise.
     '''
-    # See if this is the first check
-    if not self.forex_last_get:
-      return True
-
-    now = time.time()
-    return (now - self.forex_last_get) > self.forex_update_secs
+    return self.forex_refresher.stale()
 
   def forex_get_fresh_data(self):
     '''
     Return True if fresh data was
-    successfully obtained. False 
-    otherwise.
+    successfully obtained, by this or a
+    concurrent call. False otherwise.
+    '''
+    return self.forex_refresher.fetch()
+
+  def forex_pull_data(self):
+    '''
+    Return a dict of the latest forex data
+    and currency names, or None if an error
+    occurred.
     '''
     try:
       # Get the latest forex data
-      r = requests.get(self.FOREX_LATEST_URL)
-
-      # Save the forex data
-      for k, v in r.json().iteritems():
-        setattr(self, 'forex_'+k, v)
+      r = self.http.get(self.FOREX_LATEST_URL)
+      latest = r.json()
 
       # Get currencies if necessary
-      if not self.forex_cs:
-        r = requests.get(self.FOREX_CS_URL)
-
-        self.forex_cs = r.json()
+      forex_cs = self.forex_cs
+      if not forex_cs:
+        r = self.http.get(self.FOREX_CS_URL)
+        forex_cs = r.json()
 
-      return True
+      return {'latest': latest, 'currencies': forex_cs}
     except:
       log.err('[Error]: {}'.format(sys.exc_info()[0]))
-      return False
+      return None
+
+  def forex_use_data(self, data):
+    '''
+    Save the forex data returned by
+    forex_pull_data, swapped in at once.
+    '''
+    fresh = dict(('forex_' + str(k), v) for k, v in \
+                                      data['latest'].iteritems())
+    fresh['forex_cs'] = data['currencies']
+    self.__dict__.update(fresh)
 
   def geoip(self, msg):
     # Strip off the command
@@ -588,7 +1409,7 @@ class Lookup(Plugin):
     for ip in ips:
       try:
         # Make the request
-        r = requests.get(self.GEOIP_API.format(ip), verify=False)
+        r = self.http.get(self.GEOIP_API.format(ip), verify=False)
 
         # Check for a status code
         if r.status_code == 403:
@@ -596,7 +1417,7 @@ class Lookup(Plugin):
           log.err(reply)
           return reply, True
         elif r.status_code != 200:
-          reply = 'Invalid status code from GeoIP API. ' + \
+          reply = '[Error]: Invalid status code from GeoIP API. ' + \
                   'Please contact bot maintainer.'
           return reply, True
 
@@ -607,6 +1428,17 @@ class Lookup(Plugin):
           if geoip_dict[k]:
             info = '[{}]: {}'.format(k, geoip_dict[k])
             reply.append(str(info))
+
+        # Name the nearest big city
+        if self.cdb.spatial and geoip_dict.get('latitude') is not None:
+          near = self.cdb.nearest( float(geoip_dict['latitude'])
+                                 , float(geoip_dict['longitude'])
+                                 , 1
+                                 , self.geoip_near_population
+                                 )
+          for km, row in near:
+            reply.append('[near]: {}, {} ({:,.0f} km)'.format(
+                  row['asciiname'].encode('utf-8'), row['iso'], km))
         replies.append(', '.join(reply))
       except:
         log.err('[Error]: {}'.format(sys.exc_info()[0]))
@@ -4,7 +4,6 @@ import sys
 import time
 
 import bashquote as bq
-import requests
 
 from gilbertgrapesmom import build_help_and_info, CMND_PREFIX
 from pluginbase import Plugin
@@ -122,7 +121,7 @@ class Quotes(Plugin):
   def chuck_norris(self, msg):
     # Make a request to the page
     try:
-      r = requests.get(self.CHUCK_NORRIS_API)
+      r = self.http.get(self.CHUCK_NORRIS_API)
 
       # Check for a successful GET
       if not r.status_code == 200:
@@ -1,19 +1,31 @@
-import httplib
+from contextlib import contextmanager
+from HTMLParser import HTMLParser
 import json
 import re
 import sys
+import threading
 import time
 import urlparse
 
-from mechanize import Browser
 import pafy
-import requests
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.python import threadpool
 
 from gilbertgrapesmom import build_help_and_info, CMND_PREFIX
 from pluginbase import Plugin
+from singleflight import SingleFlight
+from ttlcache import MISS, TTLCache
 
 class URLUtils(Plugin):
   URL_RE = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
+  TITLE_RE = re.compile(r'<title[^>]*>(.*?)</title>', re.I | re.S)
+  HTML_TYPES = ('text/html', 'application/xhtml+xml')
+  YOUTUBE_RE = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|v/|' + \
+                          r'shorts/)|youtu\.be/)([\w-]{11})', re.I)
+  DEFAULT_PORTS = {'http': 80, 'https': 443}
+  PERMANENT_REDIRECTS = (301, 308)
+  trigger = 'url-title'
 
   def __init__(self, args):
     '''URLUtils.__init__(self, args)
@@ -26,6 +38,44 @@ class URLUtils(Plugin):
         - Plus viewcount and duration for YouTube
     '''
     self.yt = True if args['youtube'].lower() == 'yes' else False
+    self.http = args['http']
+    self.max_redirects = int(args.get('max_redirects', 5))
+    self.title_max_bytes = int(args.get('title_max_bytes', 65536))
+    self.max_urls = int(args.get('max_urls', 3))
+
+    # Lookups of the same URL in progress,
+    # e.g., from several channels
+    self.flights = SingleFlight()
+
+    # Cache of resolved URLs, titles and
+    # YouTube info where failures are kept
+    # for url_error_ttl seconds only
+    self.cache = TTLCache(args.get('url_cache_size', 1024))
+    self.url_ttl = float(args.get('url_ttl', 3600))
+    self.url_error_ttl = float(args.get('url_error_ttl', 300))
+
+    # Bounded pool of threads, shared by all
+    # messages, looking up the URLs of a
+    # message after its first
+    self.lookups = threadpool.ThreadPool(
+                          minthreads=0
+                        , maxthreads=int(args.get('lookup_threads', 4))
+                        , name='ggm-url-lookups'
+                        )
+    self.lookups.start()
+    reactor.callFromThread( reactor.addSystemEventTrigger
+                          , 'during', 'shutdown', self.lookups.stop)
+
+    # Requests allowed at once per domain
+    self.domain_concurrency = int(args.get('domain_concurrency', 2))
+
+    # Dictionary of domains in use where
+    #   k -> domain
+    #   v -> [semaphore, requests holding
+    #         or waiting for it]
+    # and idle domains are dropped
+    self.domain_slots = {}
+    self.domain_lock = threading.Lock()
     self.cmnds = { 'shorten': self.shorten_cmnd
                  , 'unshorten': self.unshorten_cmnd
                  }
@@ -37,13 +87,11 @@ class URLUtils(Plugin):
     passed in using Google's URL shortening
     service.
     '''
-    headers = {'Content-Type': 'application/json'
-              , 'User-Agent': 'ggm IRC bot'
-              }
+    headers = {'Content-Type': 'application/json'}
     data = json.dumps({'longUrl': url})
     shortener = 'https://www.googleapis.com/urlshortener/v1/url'
     try:
-      r = requests.post(shortener, headers=headers, data=data)
+      r = self.http.post(shortener, headers=headers, data=data)
     except:
       return '[Error]: Invalid URL', True
 
@@ -87,37 +135,225 @@ class URLUtils(Plugin):
     Return an unshortened version of the
     URL passed in.
 
-    Code from:
-      http://ow.ly/ttH5j
-    '''
-    parsed = urlparse.urlparse(url)
-    h = httplib.HTTPConnection(parsed.netloc)
-    resource = parsed.path
-    if parsed.query != '':
-      resource += '?' + parsed.query
-    h.request('HEAD', resource)
-    response = h.getresponse()
-    if response.status/100 == 3 and response.getheader('Location'):
-      return self.unshorten(response.getheader('Location'))
-    else:
-      return url
+    Redirects are followed over the pooled
+    connections of the HTTP client, and
+    resolved URLs are cached.
+
+    Raises ValueError if the URL cannot
+    be reached.
+    '''
+    resolved = self.cached(('resolved', self.normalize(url)), self.resolve, url)
+    if resolved is None:
+      raise ValueError('Cannot reach {}'.format(url))
+    return resolved
+
+  def resolve(self, url):
+    '''
+    Return the URL after following its
+    redirects or None if it cannot be
+    reached.
+    '''
+    try:
+      with self.follow(url, 'HEAD') as r:
+        return r.url if r.status_code < 400 else None
+    except Exception, exc:
+      log.msg('[URLUtils]: Cannot reach {}: {}'.format(url, exc))
+      return None
+
+  def normalize(self, url):
+    '''
+    Return url with a scheme, lower case
+    scheme and host, no default port, no
+    fragment and no trailing punctuation.
+    '''
+    url = url.rstrip('.,;:!?')
+    if '://' not in url:
+      url = 'http://' + url
+
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    try:
+      port = parts.port
+    except ValueError:
+      port = None
+    if port and port != self.DEFAULT_PORTS.get(scheme):
+      netloc += ':{}'.format(port)
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/',
+                                parts.query, ''))
+
+  def youtube_id(self, url):
+    '''
+    Return the video ID of a YouTube URL
+    or None for any other URL.
+    '''
+    match = self.YOUTUBE_RE.search(url)
+    return match.group(1) if match else None
 
-  def get_title(self, url):
+  def cached(self, key, f, *args):
     '''
-    Return the title of the passed
-    in URL.
+    Return f(*args) from the cache, or call
+    it once for all concurrent callers and
+    cache its result, for url_error_ttl
+    seconds if it is None.
     '''
-    br = Browser()
-    br.set_handle_robots(False)
-    br.open(url)
-    return 'Title: {}'.format(br.title())
+    value = self.cache.get(key)
+    if value is MISS:
+      value = self.flights.do(key, self.fill, key, f, *args)
+    return value
+
+  def fill(self, key, f, *args):
+    value = f(*args)
+    self.cache.put( key
+                  , value
+                  , self.url_ttl if value is not None else self.url_error_ttl
+                  )
+    return value
+
+  @contextmanager
+  def domain_slot(self, url):
+    '''
+    Hold one of the domain_concurrency slots
+    of the domain of url, forgetting the
+    domain once no request wants it.
+    '''
+    domain = urlparse.urlsplit(url).netloc.lower()
+    with self.domain_lock:
+      slot = self.domain_slots.get(domain)
+      if slot is None:
+        slot = [threading.BoundedSemaphore(self.domain_concurrency), 0]
+        self.domain_slots[domain] = slot
+      slot[1] += 1
+
+    try:
+      with slot[0]:
+        yield
+    finally:
+      with self.domain_lock:
+        slot[1] -= 1
+        if not slot[1]:
+          del self.domain_slots[domain]
+
+  @contextmanager
+  def follow(self, url, method='GET'):
+    '''
+    Request the URL, following at most
+    max_redirects redirects over the pooled
+    HTTP(S) connections, and give the
+    response of the last hop with its body
+    left unread, e.g.:
+
+      with self.follow(url) as r:
+        ...
+
+    The response is closed, and the slot of
+    its domain released, only when done, so
+    reading the body counts against the
+    domain_concurrency limit too.
+
+    Permanent redirects are cached, so hops
+    seen before, e.g., of a popular short
+    link, are followed without a request,
+    while temporary ones are asked again.
+
+    Raises ValueError on a redirect loop
+    or when there are more redirects.
+    '''
+    if not urlparse.urlparse(url).scheme:
+      url = 'http://' + url
+
+    seen = set()
+    for _ in range(self.max_redirects + 1):
+      if url in seen:
+        raise ValueError('Redirect loop at {}'.format(url))
+      seen.add(url)
+
+      # A known hop
+      target = self.cache.get(('hop', url))
+      if target is not MISS:
+        url = target
+        continue
+
+      with self.domain_slot(url):
+        r = self.http.request(method, url, allow_redirects=False, stream=True)
+        try:
+          if not r.is_redirect:
+            yield r
+            return
+        finally:
+          r.close()
+
+      target = urlparse.urljoin(url, r.headers['location'])
+      if r.status_code in self.PERMANENT_REDIRECTS:
+        self.cache.put(('hop', url), target, self.url_ttl)
+      url = target
+
+    raise ValueError('More than {} redirects'.format(self.max_redirects))
+
+  def get_title(self, r):
+    '''
+    Return the title of the page in the
+    streamed response r, reading no further
+    than its </title> or title_max_bytes.
+
+    Anything but a web page is summed up
+    from its headers without reading it.
+    '''
+    content_type = r.headers.get('content-type', '')
+    mime = content_type.split(';')[0].strip().lower()
+    if mime not in self.HTML_TYPES:
+      return self.summary(mime, r.headers.get('content-length'))
+
+    # Read just enough of the page
+    body = ''
+    for chunk in r.iter_content(4096):
+      body += chunk
+      if '</title>' in body.lower() or len(body) >= self.title_max_bytes:
+        break
+
+    match = self.TITLE_RE.search(body[:self.title_max_bytes])
+    if not match:
+      return None
+
+    # Without a charset, requests assumes
+    # latin-1 for text, but most pages are
+    # UTF-8 nowadays
+    encoding = r.encoding if 'charset' in content_type.lower() else 'utf-8'
+    try:
+      title = match.group(1).decode(encoding or 'utf-8', 'replace')
+    except LookupError:
+      title = match.group(1).decode('utf-8', 'replace')
+    title = ' '.join(HTMLParser().unescape(title).split())
+    return 'Title: {}'.format(title.encode('utf-8'))
+
+  def summary(self, mime, length):
+    '''
+    Return a one line summary of content
+    of type mime and length bytes.
+    '''
+    if not length or not length.isdigit():
+      return '[{}]'.format(mime or 'unknown type')
+
+    size = float(length)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+      if size < 1024 or unit == 'GB':
+        break
+      size /= 1024
+    return '[{}, {} {}]'.format(mime or 'unknown type',
+                                int(size) if unit == 'B' else round(size, 1),
+                                unit)
 
   def youtube_data(self, url):
     '''
     Return the video title, duration
-    and view count for a YouTube URL.
+    and view count for a YouTube URL or
+    video ID, or None if it is unavailable.
     '''
-    video = pafy.new(url)
+    try:
+      video = pafy.new(url)
+    except Exception, exc:
+      log.msg('[URLUtils]: No YouTube data for {}: {}'.format(url, exc))
+      return None
     title = video.title
     duration = time.strftime('%H:%M:%S', time.gmtime(video.length))
     views = video.viewcount
@@ -128,12 +364,12 @@ class URLUtils(Plugin):
   def valid_url(self, url):
     '''
     Return True if the url parameter
-    can be reached and returns a 200
-    status code.
+    can be reached, after its redirects,
+    without an error status code.
     '''
     try:
-      return requests.head(url).status_code < 400
-    except:
+      return bool(self.unshorten(url))
+    except ValueError:
       return False
 
   def commands(self):
@@ -142,18 +378,29 @@ class URLUtils(Plugin):
   def get_commands(self):
     return self.cmnds
 
+  def cache_ttls(self):
+    return { CMND_PREFIX + 'shorten': 3600
+           , CMND_PREFIX + 'unshorten': 3600
+           }
+
   def has_command(self, msg):
     # Call super class
     if super(URLUtils, self).has_command(msg):
       return True
 
-    # Parse for a URL
-    url = self.URL_RE.findall(msg)
-    if url and self.valid_url(url[0]):
-      return True
+    # Otherwise, look for a URL
+    return self.has_trigger(msg)
 
-    # Otherwise, False
-    return False
+  def has_trigger(self, msg):
+    '''
+    Return True if msg contains a URL.
+
+    Only a regex match as it runs for
+    every line on the reactor thread;
+    reaching the URL is left to the
+    title lookup.
+    '''
+    return self.URL_RE.search(msg) is not None
 
   def parse_command(self, msg):
     # Call the super class
@@ -167,17 +414,84 @@ class URLUtils(Plugin):
     elif msg.startswith(CMND_PREFIX + 'info'):
       return self.info(' '.join(msg.split()[1:]))
 
-    # Grab a URL from the passed in message
-    url = self.URL_RE.findall(msg)[0]
-    unshortened = self.unshorten(url)
+    # Describe the URLs in the passed in
+    # message, all at once, in one reply
+    titles = [t for t in self.lookup_all(self.URL_RE.findall(msg)) if t]
+    if titles:
+      return ' | '.join(titles), False
+
+  def lookup_all(self, urls):
+    '''
+    Return a list of the titles of the
+    first max_urls distinct URLs in urls,
+    in order, looked up concurrently.
+    '''
+    distinct = []
+    for url in map(self.normalize, urls):
+      if url not in distinct:
+        distinct.append(url)
+    distinct = distinct[:self.max_urls]
+
+    # Look up all but the first URL in the
+    # lookup pool, as this thread is
+    # already a worker
+    titles = [None] * len(distinct)
+    done = [threading.Event() for _ in distinct[1:]]
+    def run(i):
+      try:
+        titles[i] = self.lookup(distinct[i])
+      finally:
+        done[i - 1].set()
+    for i in range(1, len(distinct)):
+      self.lookups.callInThread(run, i)
+    if distinct:
+      titles[0] = self.lookup(distinct[0])
+    for event in done:
+      event.wait()
+    return titles
+
+  def lookup(self, url):
+    '''
+    Return the cached title or YouTube
+    info of the URL, describing it on
+    a miss.
+
+    YouTube videos are keyed by their
+    ID so all forms of their URL share
+    an entry.
+    '''
+    url = self.normalize(url)
+    vid = self.youtube_id(url) if self.yt else None
+    if vid:
+      return self.cached(('youtube', vid), self.youtube_data, vid)
+    return self.cached(('title', url), self.describe, url)
 
-    # Check if we need to worry about YouTube info
-    if self.yt:
-      if 'youtube.com' in unshortened.lower():
-        return self.youtube_data(unshortened), False
+  def describe(self, url):
+    '''
+    Return the title of the URL, or its
+    YouTube info, with a single fetch
+    following its redirects.
 
-    # Check for a URL in the msg
-    return '{}'.format(self.get_title(unshortened), url), False
+    Return None if the URL cannot be
+    reached, as it was only mentioned.
+    '''
+    # The connection is dropped rather than
+    # reading the rest of the body
+    try:
+      with self.follow(url) as r:
+        if r.status_code >= 400:
+          return None
+        self.cache.put(('resolved', url), r.url, self.url_ttl)
+
+        # Check if we need to worry about YouTube info
+        vid = self.youtube_id(r.url) if self.yt else None
+        if not vid:
+          return self.get_title(r)
+    except Exception, exc:
+      log.msg('[URLUtils]: Cannot reach {}: {}'.format(url, exc))
+      return None
+
+    return self.cached(('youtube', vid), self.youtube_data, vid)
 
   def help(self, cmd):
     # Strip prefix for aliased commands
@@ -1,21 +1,69 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
+'''
+Builds the GeoNames cities database used by
+the Lookup plugin's ?city command.
 
+The GeoNames dump is downloaded unless
+already present and loaded straight from
+the zip by a pipeline: the dump is read in
+blocks of whole lines, which a pool of
+processes parses and filters, while this
+process writes their rows to SQLite, e.g.:
+
+  python2 cities_db_2_sqlite.py
+  python2 cities_db_2_sqlite.py --zip allCountries.zip --db cities.db
+  python2 cities_db_2_sqlite.py --feature-classes P --min-population 1000
+
+Once loaded, the cities are indexed for
+?city along with full text search tables
+of their names, for prefix, alternate name
+and misspelled lookups, and an R*Tree of
+their coordinates for ?near.
+
+An existing database is kept current with
+GeoNames' daily modifications-YYYY-MM-DD.txt
+and deletes-YYYY-MM-DD.txt files, downloaded
+to a directory, by applying those newer than
+the last applied date, e.g.:
+
+  python2 cities_db_2_sqlite.py --update updates/
+
+Either way, the populated places may also
+be written to a compact read-only city
+store for the Lookup plugin to map into
+memory instead of querying SQLite, e.g.:
+
+  python2 cities_db_2_sqlite.py --update updates/ --store cities.store
+'''
 # Imports
+import argparse
 from datetime import datetime, timedelta
+import functools
+import io
+import multiprocessing
 import os
-import subprocess as sp
+import re
 import sqlite3
 import sys
+import threading
 import time
 import zipfile
 
 # 3-rd party libraries
 import requests
-import unicodecsv as csv
+
+from citystore import write_store
 
 # Constants
 CITIES_DB_URL = 'http://download.geonames.org/export/dump/allCountries.zip'
+CITIES_TXT = 'allCountries.txt'
+NUM_FIELDS = 19
+
+# Indexes of the fields converted
+# from text when parsing
+GID, ASCIINAME, LATITUDE, LONGITUDE, FEATURE_CLASS = 0, 2, 4, 5, 6
+POPULATION, ELEVATION, DEM = 14, 15, 16
 
 CITIES_DB_SQL = [
 '''DROP TABLE IF EXISTS cities''',
@@ -42,90 +90,607 @@ CITIES_DB_SQL = [
     updated TEXT
 )
 ''']
-CITIES_TXT = 'allCountries.txt'
-NUM_CITIES = sp.check_output('wc -l {}'.format(CITIES_TXT).split())
-NUM_CITIES = float(NUM_CITIES.split()[0].strip())
+
+# Built once the rows are in, for the
+# lookups of CitiesDB.query_city in
+# Lookup.py, followed by statistics for
+# the query planner
+CITIES_INDEX_SQL = [
+'''CREATE INDEX cities_asciiname_population
+    ON cities (asciiname, population DESC)''',
+
+'''CREATE INDEX cities_asciiname_iso_population
+    ON cities (asciiname, iso, population DESC)''',
+
+'''ANALYZE cities''']
+
+# Full text search over populated places
+# for names matching no city exactly where
+#   cities_search -> words of the name,
+#                    asciiname and alternate
+#                    names, by gid as rowid
+#   cities_vocab -> trigrams of each distinct
+#                   asciiname, with its largest
+#                   population, for misspellings
+SEARCH_NAMES = '''coalesce(name, '') || ' ' || coalesce(asciiname, '') || ' ' ||
+           replace(coalesce(alternate_names, ''), ',', ' ')'''
+
+CITIES_SEARCH_SQL = [
+'''DROP TABLE IF EXISTS cities_search''',
+'''DROP TABLE IF EXISTS cities_vocab''',
+
+'''CREATE VIRTUAL TABLE cities_search USING fts5(
+    names, tokenize = 'unicode61 remove_diacritics 2'
+)''',
+
+'''INSERT INTO cities_search (rowid, names)
+    SELECT gid, {}
+    FROM cities WHERE population > 0'''.format(SEARCH_NAMES),
+
+'''INSERT INTO cities_search (cities_search) VALUES ('optimize')''',
+
+'''CREATE VIRTUAL TABLE cities_vocab USING fts5(
+    name, population UNINDEXED, tokenize = 'trigram'
+)''',
+
+'''INSERT INTO cities_vocab (name, population)
+    SELECT asciiname, MAX(population)
+    FROM cities WHERE population > 0 AND length(asciiname) > 2
+    GROUP BY asciiname''',
+
+'''INSERT INTO cities_vocab (cities_vocab) VALUES ('optimize')''']
+
+# R*Tree of the coordinates of populated
+# places, by gid, for nearest place queries,
+# carrying their population to filter on
+CITIES_RTREE_SQL = [
+'''DROP TABLE IF EXISTS cities_rtree''',
+
+'''CREATE VIRTUAL TABLE cities_rtree USING rtree(
+    gid, min_lat, max_lat, min_lon, max_lon, +population
+)''',
+
+'''INSERT INTO cities_rtree
+    SELECT gid, latitude, latitude, longitude, longitude, population
+    FROM cities WHERE population > 0''']
+
+# Facts about the loaded data where
+#   last_update -> date of the last daily
+#                  update in the data
+#   feature_classes, min_population -> filters
+#                  updates are applied with
+CITIES_META_SQL = '''CREATE TABLE IF NOT EXISTS cities_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)'''
+
+# Daily update files
+UPDATE_RE = re.compile(r'^(modifications|deletes)-(\d{4}-\d{2}-\d{2})\.txt$')
+
+# Trade durability for speed while loading,
+# as the load goes to a temporary file only
+# replacing the database once complete, so
+# a failed load is simply run again
+BULK_LOAD_PRAGMAS = [
+'''PRAGMA journal_mode = OFF''',
+'''PRAGMA synchronous = OFF''',
+'''PRAGMA cache_size = -262144''',    # 256MB
+'''PRAGMA temp_store = MEMORY''',
+'''PRAGMA locking_mode = EXCLUSIVE''']
+
+INSERT_SQL = 'INSERT INTO cities VALUES ({})'.format(
+                                            ','.join(['?'] * NUM_FIELDS))
+UPSERT_SQL = INSERT_SQL.replace('INSERT', 'INSERT OR REPLACE', 1)
+DELETE_SQL = 'DELETE FROM cities WHERE gid = ?'
 
 def download_file(url):
   local_filename = url.split('/')[-1]
   r = requests.get(url, stream=True)
   with open(local_filename, 'wb') as f:
-    for chunk in r.iter_content(chunk_size=1024):
+    for chunk in r.iter_content(chunk_size=1024 * 1024):
       if chunk:   # filter out keep-alive new chunks
         f.write(chunk)
-        f.flush()
   return local_filename
 
+def open_dump(fname):
+  '''
+  Return the GeoNames dump in fname, a zip
+  or the extracted text file, as a binary
+  file object along with its size in bytes.
+  '''
+  if zipfile.is_zipfile(fname):
+    zf = zipfile.ZipFile(fname)
+    name = os.path.basename(fname).replace('.zip', '.txt')
+    if name not in zf.namelist():
+      name = [n for n in zf.namelist() if n.endswith('.txt')][0]
+    return io.BufferedReader(zf.open(name), 1024 * 1024), \
+                                            zf.getinfo(name).file_size
+  return open(fname, 'rb', 1024 * 1024), os.path.getsize(fname)
+
+class Progress(object):
+  '''
+  Progress prints how far a load is at most
+  once every interval seconds.
+  '''
+  def __init__(self, total_bytes, interval=1.0):
+    self.total = float(total_bytes) or 1.0
+    self.interval = interval
+    self.start = self.last = time.time()
+
+  def update(self, rows, done_bytes, force=False):
+    now = time.time()
+    if not force and now - self.last < self.interval:
+      return
+    self.last = now
+
+    elapsed = now - self.start
+    done = done_bytes / self.total
+    left = elapsed / done - elapsed if done else 0
+    progress = '{:.1f}% | {:,} rows | {:,.0f} rows/s | {}s elapsed | ' \
+               'Est. Time Remaining: {}s'.format( done * 100, rows
+                                                , rows / elapsed if elapsed else 0
+                                                , int(elapsed), int(left))
+    sys.stdout.write(progress + ' ' * (80 - len(progress)) + '\r')
+    sys.stdout.flush()
+
+def read_blocks(f, block_size):
+  '''
+  Yield blocks of about block_size bytes
+  of the GeoNames dump f, each ending on
+  a line boundary.
+  '''
+  rest = ''
+  while True:
+    data = f.read(block_size)
+    if not data:
+      break
+    data = rest + data
+    end = data.rfind('\n') + 1
+    rest = data[end:]
+    if end:
+      yield data[:end]
+  if rest:
+    yield rest
+
+def parse_row(line):
+  '''
+  Return the 19 fields of a line of the
+  GeoNames dump, with numbers converted,
+  or None if the line is invalid.
+  '''
+  row = line.decode('utf-8').rstrip(u'\r\n').split(u'\t')
+  if len(row) != NUM_FIELDS:
+    return None
+
+  try:
+    row[GID] = int(row[GID])
+    row[LATITUDE] = float(row[LATITUDE])
+    row[LONGITUDE] = float(row[LONGITUDE])
+    row[POPULATION] = int(row[POPULATION]) if row[POPULATION] else 0
+    row[ELEVATION] = int(row[ELEVATION]) if row[ELEVATION] else None
+    row[DEM] = int(row[DEM]) if row[DEM] else None
+  except ValueError:
+    return None
+  return row
+
+def keep(row, feature_classes=None, min_population=0):
+  '''
+  Return True if row passes the feature
+  class and population filters.
+  '''
+  if feature_classes and row[FEATURE_CLASS] not in feature_classes:
+    return False
+  return row[POPULATION] >= min_population
+
+def parse_block(block, feature_classes=None, min_population=0):
+  '''
+  Parse a block of lines of the GeoNames
+  dump, in a worker process.
+
+  Return a 2-tuple of the list of rows
+  kept and the size of the block.
+  '''
+  rows = []
+  for line in block.splitlines():
+    row = parse_row(line)
+    if row and keep(row, feature_classes, min_population):
+      rows.append(row)
+  return rows, len(block)
+
+def parsed_blocks(f, block_size, parse, workers):
+  '''
+  Yield the results of parse for every block
+  of the GeoNames dump f, parsed by a pool of
+  workers processes unless there is only one.
+
+  At most two blocks per worker are read
+  ahead of the writer.
+  '''
+  blocks = read_blocks(f, block_size)
+  if workers <= 1:
+    for block in blocks:
+      yield parse(block)
+    return
+
+  # Keep the reader from loading the whole
+  # dump into memory when the writer is
+  # the bottleneck
+  slots = threading.BoundedSemaphore(workers * 2)
+  def throttled():
+    for block in blocks:
+      slots.acquire()
+      yield block
+
+  pool = multiprocessing.Pool(workers)
+  try:
+    for result in pool.imap_unordered(parse, throttled()):
+      slots.release()
+      yield result
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+def bulk_load( con, f, total_bytes, block_size, workers, parse=parse_block
+             , meta=None):
+  '''
+  Load the GeoNames dump f into a fresh
+  cities table of con, then index it and
+  record the meta dictionary.
+
+  Without a journal, a failure leaves con
+  in an undefined state, so con should be
+  a new file to drop unless this returns.
+
+  Return the number of rows loaded.
+  '''
+  cur = con.cursor()
+  for stmnt in BULK_LOAD_PRAGMAS:
+    cur.execute(stmnt)
+
+  rows = 0
+  done = 0
+  progress = Progress(total_bytes)
+  with con:
+    for stmnt in CITIES_DB_SQL:
+      cur.execute(stmnt)
+
+    # This process is the single writer
+    for chunk, size in parsed_blocks(f, block_size, parse, workers):
+      cur.executemany(INSERT_SQL, chunk)
+      rows += len(chunk)
+      done += size
+      progress.update(rows, done)
+    progress.update(rows, total_bytes, force=True)
+
+    # Index the cities, much faster
+    # than keeping indexes while loading
+    print
+    print 'Indexing cities...'
+    for stmnt in CITIES_INDEX_SQL:
+      cur.execute(stmnt)
+
+    print 'Building the name search...'
+    for stmnt in CITIES_SEARCH_SQL:
+      cur.execute(stmnt)
+
+    print 'Building the spatial index...'
+    for stmnt in CITIES_RTREE_SQL:
+      cur.execute(stmnt)
+
+    cur.execute(CITIES_META_SQL)
+    cur.execute('DELETE FROM cities_meta')
+    write_meta(cur, meta or {})
+
+  return rows
+
 #------------------------------------------------------------#
 #                                                            #
-#                            MAIN                            #  
+#                    INCREMENTAL UPDATES                     #
 #                                                            #
 #------------------------------------------------------------#
-# See if we need to download the file
-if not os.path.exists(CITIES_TXT):
-  if not os.path.exists(CITIES_TXT.replace('.txt', '.zip')):
-    fname = download_file(CITIES_DB_URL)
-  else:
-    fname = CITIES_TXT.replace('.txt', '.zip')
-
-  # Unzip the file
-  with zipfile.ZipFile(fname, 'r') as zf:
-    zf.extractall()
-else:
-  print '[+] Cities DB already exists.'
-
-# Otherwise, add to the database
-try:
-  con = sqlite3.connect('cities.db')
+def read_meta(con):
+  '''
+  Return the cities_meta table as a
+  dictionary, empty if there is none.
+  '''
+  try:
+    return dict(con.execute('SELECT key, value FROM cities_meta'))
+  except sqlite3.OperationalError:
+    return {}
+
+def write_meta(cur, meta):
+  cur.execute(CITIES_META_SQL)
+  cur.executemany('INSERT OR REPLACE INTO cities_meta VALUES (?, ?)',
+                  [(k, str(v)) for k, v in meta.iteritems()])
+
+def has_tables(con, *names):
+  return con.execute('SELECT COUNT(*) FROM sqlite_master WHERE name IN ({})'.\
+                        format(','.join('?' * len(names))),
+                     names).fetchone()[0] == len(names)
+
+def update_search(cur, upserts, deletes):
+  '''
+  Reindex the names of the upserted and
+  deleted places in the search tables.
+
+  Names of deleted places stay in the
+  vocabulary until the next full load,
+  as they are only ever suggestions.
+  '''
+  gids = [(row[GID],) for row in upserts] + deletes
+  cur.executemany('DELETE FROM cities_search WHERE rowid = ?', gids)
+  cur.executemany('''INSERT INTO cities_search (rowid, names)
+                      SELECT gid, {} FROM cities
+                      WHERE gid = ? AND population > 0'''.format(SEARCH_NAMES),
+                  [(row[GID],) for row in upserts])
+
+  for row in upserts:
+    name = row[ASCIINAME]
+    if not row[POPULATION] or len(name) < 3:
+      continue
+    # A phrase of trigrams finds the name
+    # as a substring, then keep it if equal
+    found = cur.execute('''SELECT rowid, population FROM cities_vocab
+                           WHERE cities_vocab MATCH ? AND name = ?''',
+                        (u'"{}"'.format(name.replace('"', '""')), name)).fetchone()
+    if found is None:
+      cur.execute('INSERT INTO cities_vocab (name, population) VALUES (?, ?)',
+                  (name, row[POPULATION]))
+    elif int(found[1]) < row[POPULATION]:
+      cur.execute('UPDATE cities_vocab SET population = ? WHERE rowid = ?',
+                  (row[POPULATION], found[0]))
+
+def update_rtree(cur, upserts, deletes):
+  '''
+  Move the upserted and deleted places
+  in the R*Tree.
+  '''
+  cur.executemany('DELETE FROM cities_rtree WHERE gid = ?',
+                  [(row[GID],) for row in upserts] + deletes)
+  cur.executemany('INSERT INTO cities_rtree VALUES (?, ?, ?, ?, ?, ?)',
+                  [ (row[GID], row[LATITUDE], row[LATITUDE], row[LONGITUDE],
+                     row[LONGITUDE], row[POPULATION])
+                    for row in upserts if row[POPULATION] > 0 ])
+
+def pending_updates(update_dir, last_update):
+  '''
+  Return a list of (date, files) 2-tuples,
+  oldest first, of the daily updates in
+  update_dir newer than last_update, where
+  files is a dictionary of the paths of its
+  modifications and/or deletes file.
+  '''
+  updates = {}
+  for name in os.listdir(update_dir):
+    match = UPDATE_RE.match(name)
+    if match and match.group(2) > (last_update or ''):
+      updates.setdefault(match.group(2), {})[match.group(1)] = \
+                                              os.path.join(update_dir, name)
+  return sorted(updates.items())
+
+def apply_update(con, date, files, feature_classes=None, min_population=0):
+  '''
+  Apply the modifications then the deletes
+  of a daily update, by gid, and record its
+  date, all in one transaction.
+
+  Modified places no longer passing the
+  filters of the load are deleted, and the
+  search tables and R*Tree follow the
+  changes.
+
+  Return the number of upserts and deletes.
+  '''
+  upserts = []
+  deletes = []
+  if 'modifications' in files:
+    with open(files['modifications'], 'rb') as f:
+      for line in f:
+        row = parse_row(line)
+        if row is None:
+          continue
+        if keep(row, feature_classes, min_population):
+          upserts.append(row)
+        else:
+          deletes.append((row[GID],))
+
+  if 'deletes' in files:
+    with open(files['deletes'], 'rb') as f:
+      for line in f:
+        gid = line.split('\t', 1)[0].strip()
+        if gid.isdigit():
+          deletes.append((int(gid),))
+
   with con:
-    # Get a cursor
     cur = con.cursor()
+    cur.executemany(UPSERT_SQL, upserts)
+    cur.executemany(DELETE_SQL, deletes)
+    if has_tables(con, 'cities_search', 'cities_vocab'):
+      update_search(cur, upserts, deletes)
+    if has_tables(con, 'cities_rtree'):
+      update_rtree(cur, upserts, deletes)
+    write_meta(cur, {'last_update': date})
 
-    # Delete all entries from table
-    for stmnt in CITIES_DB_SQL:
-      cur.execute(stmnt)
+  return len(upserts), len(deletes)
+
+def update(con, update_dir):
+  '''
+  Apply the daily updates in update_dir
+  newer than the last one applied.
+
+  Return the number of updates applied.
+  '''
+  meta = read_meta(con)
+  feature_classes = meta.get('feature_classes') or None
+  min_population = int(meta.get('min_population') or 0)
 
-    csv.field_size_limit(sys.maxsize)
-    reader = csv.reader(open('allCountries.txt'), delimiter='\t', quotechar='"')
-    line_cnt = 0
+  updates = pending_updates(update_dir, meta.get('last_update'))
+  if not updates:
+    print '[+] Up to date as of {}'.format(meta.get('last_update', 'never'))
+  for date, files in updates:
+    upserts, deletes = apply_update( con, date, files
+                                   , feature_classes, min_population)
+    print '[+] Applied {}: {:,} upserts, {:,} deletes'.format(
+                                                    date, upserts, deletes)
+  return len(updates)
+
+#------------------------------------------------------------#
+#                                                            #
+#                        CITY STORE                          #
+#                                                            #
+#------------------------------------------------------------#
+def store(con, fname):
+  '''
+  Write the populated places of con to
+  the city store fname.
+
+  Return the number of places written.
+  '''
+  # In the order of the asciiname index,
+  # whose text compares as UTF-8 bytes
+  rows = con.execute('''SELECT asciiname, gid, iso, timezone, population,
+                               latitude, longitude
+                        FROM cities WHERE population > 0
+                        ORDER BY asciiname, population DESC''')
+  return write_store(rows, fname)
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Build the GeoNames cities DB')
+  parser.add_argument('--zip', default=CITIES_TXT.replace('.txt', '.zip'),
+                      help='GeoNames dump, downloaded if missing; the '
+                           'extracted text file works as well')
+  parser.add_argument('--db', default='cities.db')
+  parser.add_argument('--block-size', type=int, default=4 * 1024 * 1024,
+                      help='Bytes of the dump parsed at a time')
+  parser.add_argument('--workers', type=int,
+                      default=max(1, multiprocessing.cpu_count() - 1),
+                      help='Processes parsing the dump (1 to parse inline)')
+  parser.add_argument('--feature-classes',
+                      help='Only load these GeoNames feature classes, e.g., P')
+  parser.add_argument('--min-population', type=int, default=0,
+                      help='Only load places with at least this population')
+  parser.add_argument('--dump-date',
+                      help='Date (YYYY-MM-DD) of the last daily update in '
+                           'the dump; pass it for a dump not downloaded by '
+                           'this run, as it is otherwise guessed from when '
+                           'the dump was last modified')
+  parser.add_argument('--update', metavar='DIR',
+                      help='Apply the daily update files in DIR to the '
+                           'existing DB instead of loading the dump')
+  parser.add_argument('--store', metavar='FILE',
+                      help='Then write the populated places to the city '
+                           'store FILE, for cities_backend: mmap')
+  return parser.parse_args()
+
+def dump_date(fname, downloaded=False):
+  '''
+  Return the date of the last daily update
+  in the dump fname, guessed as the day
+  before it was last modified, as GeoNames
+  exports the dump with the previous day's
+  changes.
+
+  Unless the dump was just downloaded, the
+  guess is wrong for one kept or copied for
+  days, and --update would skip or reapply
+  daily updates, so warn loudly.
+  '''
+  modified = datetime.utcfromtimestamp(os.path.getmtime(fname))
+  date = (modified - timedelta(days=1)).strftime('%Y-%m-%d')
+  if not downloaded:
+    print '[!] WARNING: assuming {} has the daily updates up to {}, ' \
+          'from when it was last modified.'.format(fname, date)
+    print '[!] WARNING: if not, pass --dump-date or --update will skip ' \
+          'or reapply daily updates.'
+  return date
+
+#------------------------------------------------------------#
+#                                                            #
+#                            MAIN                            #
+#                                                            #
+#------------------------------------------------------------#
+def main():
+  args = parse_args()
+
+  # Only apply daily updates
+  if args.update:
+    con = sqlite3.connect(args.db)
+    try:
+      update(con, args.update)
+      if args.store:
+        print '[+] Wrote {:,} places to {}'.format(store(con, args.store),
+                                                   args.store)
+    except sqlite3.Error, e:
+      print 'Error %s:' % e.args[0]
+      sys.exit(1)
+    finally:
+      con.close()
+    return
+
+  # See if we need to download the file
+  fname = args.zip
+  downloaded = False
+  if not os.path.exists(fname):
+    if os.path.exists(CITIES_TXT):
+      fname = CITIES_TXT
+    else:
+      print '[+] Downloading {}'.format(CITIES_DB_URL)
+      fname = download_file(CITIES_DB_URL)
+      downloaded = True
+  print '[+] Loading {}'.format(fname)
+
+  # Load the dump into a new database
+  # which replaces any old one at once,
+  # so bots with it open keep theirs
+  tmp = args.db + '.tmp'
+  if os.path.exists(tmp):
+    os.remove(tmp)
+  con = None
+  try:
+    f, total_bytes = open_dump(fname)
+    con = sqlite3.connect(tmp)
+    parse = functools.partial( parse_block
+                             , feature_classes=args.feature_classes
+                             , min_population=args.min_population
+                             )
+    meta = { 'last_update': args.dump_date or dump_date(fname, downloaded)
+           , 'feature_classes': args.feature_classes or ''
+           , 'min_population': args.min_population
+           }
     start = time.time()
-    for row in reader:
-      if len(row) != 19:
-        #print 'Incorrect number of fields'
-        line_cnt += 1
-        continue
-        #raise sqlite3.Error('Invalid number of fields for GeoNames cities db')
-      
-      cur.execute('INSERT INTO cities values (' + \
-                  ','.join(['?' for n in range(19)]) + ')', row)
-      line_cnt += 1
-      percent_done = round(line_cnt / NUM_CITIES * 100, 2)
-      time_elapsed = datetime.fromtimestamp(time.time()) - \
-                      datetime.fromtimestamp(start)
-      time_elapsed = str(time_elapsed)
-      left = NUM_CITIES - line_cnt
-      rate = line_cnt / float(time.time() - start)
-      etr = timedelta(seconds=left/rate)
-      progress = str(percent_done) + '% complete | ' + \
-                 str(time_elapsed) + ' elapsed | ' + \
-                 'Est. Time Remaining: ' + str(etr)
-
-      print progress + ' ' * (80 - len(progress)) + '\r',
-      
-  print
-  print 'Successfully created GeoNames cities DB'
-
-except KeyboardInterrupt:
-  if con:
-    con.rollback()
-
-except sqlite3.Error, e:
-  if con:
-    con.rollback()
-
-  print 'Error %s:' % e.args[0]
-  sys.exit(1)
-
-finally:
-  if con:
+    rows = bulk_load( con, f, total_bytes, args.block_size, args.workers
+                    , parse, meta)
+    elapsed = time.time() - start
+
+    if args.store:
+      print '[+] Wrote {:,} places to {}'.format(store(con, args.store),
+                                                 args.store)
+
     con.close()
+    con = None
+    os.rename(tmp, args.db)
+
+    print 'Successfully created GeoNames cities DB'
+    print 'Loaded {:,} rows in {:.1f}s ({:,.0f} rows/s)'.format(
+                                      rows, elapsed, rows / max(elapsed, 1e-6))
+
+  except KeyboardInterrupt:
+    pass
+
+  except sqlite3.Error, e:
+    print 'Error %s:' % e.args[0]
+    sys.exit(1)
+
+  finally:
+    # Drop a failed load, leaving
+    # the database as it was
+    if con:
+      con.close()
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,143 @@
+# Imports
+import mmap
+import os
+import struct
+
+# Constants
+MAGIC = 'GGMCITY1'
+
+# Header of the store where
+#   magic, count of records,
+#   offset of the string pool
+HEADER = struct.Struct('<8sIQ')
+
+# Fixed-width record of a place where
+#   name offset, name length,
+#   gid, iso, timezone offset,
+#   timezone length, population,
+#   latitude, longitude
+# and offsets are into the string pool
+RECORD = struct.Struct('<IHI2sIHQdd')
+NAME = struct.Struct('<IH')
+
+# Columns of a record, in order, and the
+# only ones ?city can show from a store
+COLUMNS = ('gid', 'iso', 'timezone', 'population', 'latitude', 'longitude')
+
+def write_store(rows, fname):
+  '''
+  Write a store of rows, (asciiname, gid,
+  iso, timezone, population, latitude,
+  longitude) tuples sorted by the UTF-8
+  bytes of asciiname then population,
+  largest first, to fname.
+
+  The store replaces fname at once, so
+  bots with the old one mapped keep it.
+
+  Return the number of records written.
+  '''
+  # Each distinct string is pooled once
+  pool = []
+  offsets = {}
+  pool_size = [0]
+  def pooled(s):
+    s = (s or u'').encode('utf-8')
+    if s not in offsets:
+      offsets[s] = pool_size[0]
+      pool.append(s)
+      pool_size[0] += len(s)
+    return offsets[s], len(s)
+
+  records = []
+  for name, gid, iso, timezone, population, lat, lon in rows:
+    name_off, name_len = pooled(name)
+    tz_off, tz_len = pooled(timezone)
+    records.append(RECORD.pack( name_off, name_len, gid
+                              , (iso or '').encode('ascii', 'replace')
+                              , tz_off, tz_len, population or 0, lat, lon))
+
+  tmp = fname + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(HEADER.pack( MAGIC, len(records)
+                       , HEADER.size + len(records) * RECORD.size))
+    f.write(''.join(records))
+    f.write(''.join(pool))
+  os.rename(tmp, fname)
+  return len(records)
+
+class CityStore(object):
+  '''
+  CityStore reads a store written by
+  write_store through a read-only memory
+  map, so every process mapping it shares
+  one copy in the page cache.
+
+  Records are sorted by name, so those of
+  a name are found by binary search and
+  follow each other, most populous first.
+  '''
+  def __init__(self, fname):
+    self.fname = fname
+    with open(fname, 'rb') as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      st = os.fstat(f.fileno())
+      self.version = (st.st_ino, st.st_mtime)
+
+    magic, self.count, self.pool = HEADER.unpack_from(self.mm, 0)
+    if magic != MAGIC:
+      raise ValueError('{} is not a city store'.format(fname))
+
+  def name(self, i):
+    '''
+    Return the UTF-8 name of record i.
+    '''
+    off, length = NAME.unpack_from(self.mm, HEADER.size + i * RECORD.size)
+    return self.mm[self.pool + off:self.pool + off + length]
+
+  def find(self, name):
+    '''
+    Return the index of the first record
+    called name, a UTF-8 string, or of
+    where it would be.
+    '''
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.name(mid) < name:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def records(self, name):
+    '''
+    Yield the records called name, a UTF-8
+    string, most populous first, as tuples
+    of the values of COLUMNS.
+    '''
+    i = self.find(name)
+    while i < self.count and self.name(i) == name:
+      (_, _, gid, iso, tz_off, tz_len, population, lat, lon) = \
+            RECORD.unpack_from(self.mm, HEADER.size + i * RECORD.size)
+      timezone = self.mm[self.pool + tz_off:self.pool + tz_off + tz_len]
+      yield ( gid, iso.rstrip('\0'), timezone.decode('utf-8')
+            , population, lat, lon)
+      i += 1
+
+  def replaced(self):
+    '''
+    Return True if fname is no longer the
+    file mapped, as write_store replaced it.
+    '''
+    try:
+      st = os.stat(self.fname)
+    except OSError:
+      return False
+    return (st.st_ino, st.st_mtime) != self.version
+
+  def __len__(self):
+    return self.count
+
+  def close(self):
+    self.mm.close()
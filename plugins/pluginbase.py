@@ -1,4 +1,6 @@
 # Imports
+import os
+
 from gilbertgrapesmom import build_help_and_info, CMND_PREFIX
 
 class Plugin(object):
@@ -8,7 +10,14 @@ class Plugin(object):
   Defines stubs for required methods
   that any plugin must define for 
   command parsing to function.
+
+  Plugins reacting to lines without a
+  command, e.g., URLs, set trigger to a
+  name for the behavior and override
+  has_trigger.
   '''
+  trigger = None
+
   def __init__(self):
     pass
 
@@ -48,6 +57,16 @@ class Plugin(object):
     # Otherwise, False
     return False
 
+  def has_trigger(self, msg):
+    '''
+    Return True if msg, which contains
+    no command, should still be handled
+    by this plugin.
+
+    Return False otherwise
+    '''
+    return False
+
   def parse_command(self, msg):
     '''
     Parse a line of text for a command
@@ -59,15 +78,54 @@ class Plugin(object):
               to be sent in a PM
     '''
     # Check for standard commands
-    # But first sort by longest
-    # command name desc order
-    cmnds = sorted( self.get_commands().iteritems()
-                  , key=lambda x: len(x[0])
-                  , reverse=True
-                  )
-    for cmnd, cmnd_cb in cmnds:
-      if msg.startswith(cmnd):
-        return cmnd_cb(msg)
+    # keyed on the first token
+    tokens = msg.split(None, 1)
+    cmnd_cb = self.get_commands().get(tokens[0]) if tokens else None
+    if cmnd_cb:
+      return cmnd_cb(msg)
+
+  def refreshers(self):
+    '''
+    Return a list of Refresher objects
+    keeping the plugin's upstream data
+    fresh in the background.
+    '''
+    return []
+
+  def cache_ttls(self):
+    '''
+    Return a dictionary of idempotent
+    commands whose replies may be cached
+    where
+
+      k -> prefixed command
+      v -> seconds a reply stays valid
+    '''
+    return {}
+
+  def cacheable(self, cmnd, reply):
+    '''
+    Return True if reply, the (reply, priv)
+    2-tuple cmnd returned, may be cached.
+
+    Replies reporting a failure, which by
+    default start with [Error], must not be,
+    so the command is retried once the
+    upstream API recovers.
+    '''
+    return bool(reply) and not (isinstance(reply[0], basestring) and
+                                reply[0].startswith('[Error]'))
+
+  def cache_file(self, name):
+    '''
+    Return the path of the file caching
+    the upstream data called name, or None
+    if the plugin has no cache_dir.
+    '''
+    cache_dir = getattr(self, 'cache_dir', None)
+    if not cache_dir:
+      return None
+    return os.path.join(cache_dir, name + '.json.gz')
 
   def info(self, cmd):
     '''
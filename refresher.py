@@ -0,0 +1,204 @@
+# Imports
+import gzip
+import json
+import os
+import time
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import log
+
+from singleflight import SingleFlight
+
+class Refresher(object):
+  '''
+  Refresher keeps a plugin's snapshot of
+  upstream data fresh in the background,
+  so commands always answer right away from
+  the last good snapshot.
+
+  pull is a blocking callable returning the
+  raw upstream data, or None on failure, and
+  use swaps the raw data into the plugin at
+  once. They are called every interval
+  seconds in the worker pool; a failed
+  refresh keeps the old data.
+
+  When given a cache file, every pulled
+  snapshot is saved to it as gzip'ed JSON
+  so the plugin can start from it and
+  revalidate in the background.
+
+  A snapshot older than max_staleness seconds
+  is still served but flagged as stale.
+
+  Concurrent fetches, e.g., from commands
+  finding no snapshot while a refresh is
+  running, share a single pull.
+
+  Callables added with subscribe are called
+  with no arguments whenever fresh data was
+  pulled and used.
+  '''
+  def __init__(self, name, pull, use, interval, max_staleness, cache=None):
+    self.name = name
+    self.pull = pull
+    self.use = use
+    self.interval = float(interval)
+    self.max_staleness = float(max_staleness)
+    self.cache = cache
+    self.subscribers = []
+    self.flights = SingleFlight()
+
+    # Time of the last successful fetch
+    self.last_update = None
+    self.refreshing = False
+    self.cached = False
+    self.loop = task.LoopingCall(self.refresh)
+
+  def start(self, pool):
+    '''
+    Start refreshing in pool once the
+    reactor is running, right away if the
+    snapshot came from the cache.
+    '''
+    self.pool = pool
+    reactor.callWhenRunning( self.loop.start
+                           , self.interval
+                           , now=self.cached
+                           )
+
+  def fetch(self):
+    '''
+    Pull fresh data, use it and save it
+    to the cache, joining any fetch already
+    in progress.
+
+    Return True if successful and False
+    otherwise.
+    '''
+    return self.flights.do(self.name, self.fetch_once)
+
+  def fetch_once(self):
+    data = self.pull()
+    if data is None:
+      return False
+
+    self.use(data)
+    self.last_update = time.time()
+    self.cached = False
+    self.save(data)
+    for f in self.subscribers:
+      f()
+    return True
+
+  def subscribe(self, f):
+    '''
+    Call f whenever fresh data is used.
+    '''
+    self.subscribers.append(f)
+
+  def refresh(self):
+    '''
+    Called by the LoopingCall to fetch
+    fresh data in a worker thread.
+    '''
+    if self.refreshing:
+      return
+    self.refreshing = True
+
+    d = self.pool.run(self, self.fetch)
+    d.addCallback(self.refreshed)
+    d.addErrback(log.err, '[Error]: Refreshing {} failed'.format(self.name))
+    d.addBoth(self.done)
+
+  def refreshed(self, ok):
+    if not ok:
+      log.err('[Error]: Refreshing {} failed, keeping old data'.format(
+                                                                self.name))
+
+  def done(self, _):
+    self.refreshing = False
+
+  def ensure(self):
+    '''
+    Fetch the data in the calling thread if
+    no snapshot was ever loaded.
+
+    Return True if a snapshot is available.
+    '''
+    if self.last_update is None:
+      self.fetch()
+    return self.last_update is not None
+
+  def save(self, data):
+    '''
+    Save data to the cache file, if any.
+    '''
+    if not self.cache:
+      return
+
+    try:
+      cache_dir = os.path.dirname(self.cache)
+      if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+      tmp = self.cache + '.tmp'
+      with gzip.open(tmp, 'wb') as f:
+        json.dump({'time': self.last_update, 'data': data}, f,
+                  separators=(',', ':'))
+      os.rename(tmp, self.cache)
+    except (IOError, OSError, TypeError, ValueError), exc:
+      log.err('[Error]: Cannot cache {}: {}'.format(self.name, exc))
+
+  def load(self):
+    '''
+    Use the snapshot saved in the cache
+    file, if any.
+
+    Return True if a snapshot was loaded.
+    '''
+    if not self.cache or not os.path.exists(self.cache):
+      return False
+
+    try:
+      with gzip.open(self.cache, 'rb') as f:
+        snapshot = json.load(f)
+      self.use(snapshot['data'])
+    except Exception, exc:
+      log.err('[Error]: Cannot load cached {}: {}'.format(self.name, exc))
+      return False
+
+    self.last_update = snapshot['time']
+    self.cached = True
+    return True
+
+  def age(self):
+    '''
+    Return the age of the snapshot in
+    seconds or None if there is none.
+    '''
+    if self.last_update is None:
+      return None
+    return time.time() - self.last_update
+
+  def stale(self):
+    '''
+    Return True if there is no snapshot or
+    it is older than max_staleness.
+    '''
+    age = self.age()
+    return age is None or age > self.max_staleness
+
+  def note(self):
+    '''
+    Return a note on the age of a stale
+    snapshot to add to a reply, or an empty
+    string if it is fresh enough.
+    '''
+    if not self.stale():
+      return ''
+    age = self.age()
+    if age is None:
+      return ' | [Stale]: no data'
+    return ' | [Stale]: data is {} minutes old'.format(int(age / 60))
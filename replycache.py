@@ -0,0 +1,120 @@
+# Imports
+from collections import OrderedDict
+import threading
+import time
+
+class ReplyCache(object):
+  '''
+  ReplyCache is a TTL and LRU bounded cache
+  of command replies shared across channels
+  and connections.
+
+  Plugins opt in per command through their
+  cache_ttls method, which maps prefixed
+  commands to the seconds their replies
+  stay valid. Replies are keyed on the
+  command and its whitespace normalized
+  arguments; replies the plugin's cacheable
+  method rejects, e.g., errors, are not
+  cached.
+
+  Entries of a plugin are dropped when it
+  refreshes its upstream data.
+  '''
+  def __init__(self, size):
+    self.size = int(size)
+    self.lock = threading.Lock()
+
+    # Dictionary of cached replies where
+    #   k -> (command, normalized msg)
+    #   v -> (expiry time, plugin, reply)
+    # in least to most recently used order
+    self.replies = OrderedDict()
+
+    # Dictionary of counters where
+    #   k -> command
+    #   v -> [hits, misses]
+    self.counters = {}
+
+  def ttl(self, plugin, cmnd):
+    '''
+    Return the TTL of cmnd's replies or
+    None if plugin does not cache them.
+    '''
+    cache_ttls = getattr(plugin, 'cache_ttls', None)
+    return cache_ttls().get(cmnd) if cache_ttls else None
+
+  def key(self, cmnd, msg):
+    return cmnd, ' '.join(msg.split())
+
+  def count(self, cmnd, hit):
+    counter = self.counters.setdefault(cmnd, [0, 0])
+    counter[0 if hit else 1] += 1
+
+  def get(self, cmnd, msg):
+    '''
+    Return the cached reply to msg or None
+    if there is none or it expired.
+    '''
+    key = self.key(cmnd, msg)
+    with self.lock:
+      cached = self.replies.pop(key, None)
+      if cached and cached[0] > time.time():
+        self.replies[key] = cached
+        self.count(cmnd, True)
+        return cached[2]
+      self.count(cmnd, False)
+      return None
+
+  def put(self, plugin, cmnd, msg, ttl, reply):
+    '''
+    Cache reply to msg for ttl seconds,
+    evicting the least recently used
+    replies beyond the size bound, unless
+    plugin says it is not cacheable.
+    '''
+    cacheable = getattr(plugin, 'cacheable', None)
+    if not reply or (isinstance(reply[0], basestring) and \
+                        reply[0].startswith('[Error]')) or \
+        (cacheable and not cacheable(cmnd, reply)):
+      return
+
+    with self.lock:
+      self.replies[self.key(cmnd, msg)] = (time.time() + ttl, plugin, reply)
+      while len(self.replies) > self.size:
+        self.replies.popitem(last=False)
+
+  def call(self, plugin, cmnd, f, msg):
+    '''
+    Return f(msg), answering from the cache
+    when cmnd of plugin is cacheable.
+    '''
+    ttl = self.ttl(plugin, cmnd)
+    if not ttl:
+      return f(msg)
+
+    reply = self.get(cmnd, msg)
+    if reply is None:
+      reply = f(msg)
+      self.put(plugin, cmnd, msg, float(ttl), reply)
+    return reply
+
+  def invalidate(self, plugin):
+    '''
+    Drop all cached replies of plugin.
+    '''
+    with self.lock:
+      for key, cached in self.replies.items():
+        if cached[1] is plugin:
+          del self.replies[key]
+
+  def summary(self):
+    '''
+    Return a dictionary of the number of
+    cached replies and total hits and misses.
+    '''
+    with self.lock:
+      return { 'size': len(self.replies)
+             , 'hits': sum(c[0] for c in self.counters.itervalues())
+             , 'misses': sum(c[1] for c in self.counters.itervalues())
+             }
@@ -0,0 +1,68 @@
+# Imports
+import sys
+import threading
+
+class Flight(object):
+  '''
+  A call in progress and, once done,
+  its result or exception info.
+  '''
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exc_info = None
+    self.waiters = 0
+
+class SingleFlight(object):
+  '''
+  SingleFlight coalesces concurrent calls
+  for the same key, e.g., an upstream URL,
+  so only the first caller does the work
+  and the others wait for and share its
+  result, or its exception.
+
+  Nothing is kept once a call is done; use
+  a cache for that.
+  '''
+  def __init__(self):
+    self.lock = threading.Lock()
+
+    # Dictionary of calls in progress where
+    #   k -> key of the call
+    #   v -> Flight
+    self.flights = {}
+
+    # Number of calls which shared
+    # the result of another
+    self.shared = 0
+
+  def do(self, key, f, *args, **kwargs):
+    '''
+    Return f(*args, **kwargs), or the result
+    of the call for key already in progress.
+    '''
+    with self.lock:
+      flight = self.flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self.flights[key] = Flight()
+      else:
+        flight.waiters += 1
+        self.shared += 1
+
+    if not leader:
+      flight.done.wait()
+      if flight.exc_info:
+        raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+      return flight.result
+
+    try:
+      flight.result = f(*args, **kwargs)
+      return flight.result
+    except:
+      flight.exc_info = sys.exc_info()
+      raise
+    finally:
+      with self.lock:
+        del self.flights[key]
+      flight.done.set()
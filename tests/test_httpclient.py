@@ -0,0 +1,62 @@
+#!/usr/bin/env python2
+'''
+Checks that the HTTP client's DNS cache is
+its own and bounded, e.g.:
+
+  python2 -m unittest discover tests
+'''
+# Imports
+import BaseHTTPServer
+import os
+import socket
+import sys
+import threading
+import unittest
+
+# The bot's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from httpclient import DNSCache, HTTPClient
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Length', '2')
+    self.end_headers()
+    self.wfile.write('ok')
+
+  def log_message(self, *args):
+    pass
+
+class DNSCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_lookups_are_cached_by_the_client_only(self):
+    getaddrinfo = socket.getaddrinfo
+    http = HTTPClient(None, dns_ttl=300)
+    self.assertIs(socket.getaddrinfo, getaddrinfo)
+
+    url = 'http://localhost:{}/'.format(self.server.server_port)
+    self.assertEqual(http.session.get(url).text, 'ok')
+    self.assertEqual(len(http.dns.cache), 1)
+
+    # Other clients resolve on their own
+    other = HTTPClient(None, dns_ttl=300)
+    self.assertEqual(len(other.dns.cache), 0)
+
+  def test_cache_is_bounded(self):
+    dns = DNSCache(300, size=2)
+    for port in (80, 443, 8080):
+      dns('localhost', port)
+    self.assertEqual(len(dns.cache), 2)
+
+if __name__ == '__main__':
+  unittest.main()
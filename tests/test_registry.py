@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+'''
+Checks that commands claimed by two plugins,
+loaded or not, are reported as duplicates, e.g.:
+
+  python2 -m unittest discover tests
+'''
+# Imports
+import os
+import sys
+import unittest
+
+from twisted.python import log
+
+# The bot's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gilbertgrapesmom import CommandRegistry
+from pluginloader import LazyPlugin
+
+def lazy(module, cmnds):
+  return LazyPlugin(module, module, {}, cmnds, lambda proxy, plugin: None)
+
+class DuplicatesTest(unittest.TestCase):
+  def test_lazy_plugins_claiming_a_command(self):
+    registry = CommandRegistry()
+    first = lazy('Lookup', ['?city', '?near'])
+    second = lazy('Quotes', ['?city'])
+
+    self.assertEqual(registry.register(first), [])
+    self.assertEqual(registry.register(second), ['?city'])
+    self.assertIs(registry.cmnds['?city'].plugin, first)
+
+  def test_duplicates_name_the_plugin(self):
+    errors = []
+    observer = lambda event: errors.append(log.textFromEventDict(event))
+    log.addObserver(observer)
+    self.addCleanup(log.removeObserver, observer)
+
+    registry = CommandRegistry()
+    registry.register(lazy('Lookup', ['?city']))
+    registry.register(lazy('Quotes', ['?city']))
+    self.assertIn('Duplicate commands from Quotes ignored: ?city', errors[-1])
+
+  def test_loaded_plugin_replaces_its_proxy(self):
+    registry = CommandRegistry()
+    proxy = lazy('Lookup', ['?city'])
+    registry.register(proxy)
+
+    plugin = lazy('Lookup', ['?city'])
+    registry.unregister(proxy)
+    self.assertEqual(registry.register(plugin), [])
+    self.assertIs(registry.cmnds['?city'].plugin, plugin)
+
+if __name__ == '__main__':
+  unittest.main()
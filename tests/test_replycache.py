@@ -0,0 +1,115 @@
+#!/usr/bin/env python2
+'''
+Checks that failed replies of cached commands
+are not served from the reply cache, e.g.:
+
+  python2 -m unittest discover tests
+'''
+# Imports
+import os
+import sys
+import unittest
+
+# The bot's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plugins.Lookup import Lookup
+from replycache import ReplyCache
+
+class Response(object):
+  def __init__(self, status_code, data=None):
+    self.status_code = status_code
+    self.data = data
+
+  def json(self):
+    return self.data
+
+class HTTP(object):
+  '''
+  Answers every GET with the next of a
+  list of responses, counting the calls.
+  '''
+  def __init__(self, responses):
+    self.responses = list(responses)
+    self.calls = 0
+
+  def get(self, *args, **kwargs):
+    self.calls += 1
+    return self.responses.pop(0)
+
+class Refresher(object):
+  def __init__(self, results):
+    self.results = list(results)
+    self.calls = 0
+
+  def ensure(self):
+    self.calls += 1
+    return self.results.pop(0)
+
+class CitiesDB(object):
+  spatial = False
+
+def lookup():
+  '''
+  Return a Lookup without any of its
+  data or upstream APIs.
+  '''
+  lu = Lookup.__new__(Lookup)
+  lu.forex_updates_secs = 3600
+  lu.GEOIP_API = '{}'
+  lu.cdb = CitiesDB()
+  lu.cmnds = {'?forex': lu.forex, '?geoip': lu.geoip}
+  return lu
+
+class FailedRepliesTest(unittest.TestCase):
+  def setUp(self):
+    self.replies = ReplyCache(16)
+    self.lu = lookup()
+
+  def call(self, msg):
+    cmnd = msg.split()[0]
+    return self.replies.call(self.lu, cmnd, self.lu.parse_command, msg)
+
+  def test_failed_geoip_is_retried(self):
+    geoip = { 'ip': '192.0.2.1', 'city': 'Paris', 'country_code': 'FR'
+            , 'latitude': None, 'longitude': None }
+    self.lu.http = HTTP([Response(500), Response(200, geoip)])
+
+    failed = self.call('?geoip 192.0.2.1')
+    self.assertTrue(failed[0].startswith('[Error]'))
+
+    # The API recovered, so it is asked again
+    reply = self.call('?geoip 192.0.2.1')
+    self.assertEqual(self.lu.http.calls, 2)
+    self.assertIn('[city]: Paris', reply[0])
+
+    # Only now is the reply cached
+    self.assertEqual(self.call('?geoip 192.0.2.1'), reply)
+    self.assertEqual(self.lu.http.calls, 2)
+
+  def test_failed_forex_is_retried(self):
+    self.lu.forex_refresher = Refresher([False, False])
+
+    self.assertTrue(self.call('?forex USD EUR')[0].startswith('[Error]'))
+    self.call('?forex USD EUR')
+    self.assertEqual(self.lu.forex_refresher.calls, 2)
+    self.assertEqual(self.replies.summary()['size'], 0)
+
+class Plugin(object):
+  def cache_ttls(self):
+    return {'?city': 60}
+
+class UnicodeRepliesTest(unittest.TestCase):
+  def test_non_ascii_reply_is_cached(self):
+    replies = ReplyCache(16)
+    calls = []
+    def city(msg):
+      calls.append(msg)
+      return u'[About Z\xfcrich]: CH', False
+
+    reply = replies.call(Plugin(), '?city', city, '?city Zurich')
+    self.assertEqual(replies.call(Plugin(), '?city', city, '?city Zurich'), reply)
+    self.assertEqual(len(calls), 1)
+
+if __name__ == '__main__':
+  unittest.main()
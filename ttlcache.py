@@ -0,0 +1,58 @@
+# Imports
+from collections import OrderedDict
+import threading
+import time
+
+# Returned by TTLCache.get for keys
+# missing or expired
+MISS = object()
+
+class TTLCache(object):
+  '''
+  TTLCache is a thread safe mapping whose
+  entries expire after their own TTL and
+  which keeps at most size entries, dropping
+  the least recently used first.
+
+  None is a valid value, e.g., to cache
+  a failure, so a miss is told apart by
+  the MISS sentinel.
+  '''
+  def __init__(self, size):
+    self.size = int(size)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+    # Dictionary of entries where
+    #   k -> key
+    #   v -> (expiry time, value)
+    # in least to most recently used order
+    self.entries = OrderedDict()
+
+  def get(self, key):
+    '''
+    Return the value cached for key
+    or MISS.
+    '''
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry and entry[0] > time.time():
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+      return MISS
+
+  def put(self, key, value, ttl):
+    '''
+    Cache value under key for ttl seconds.
+    '''
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (time.time() + float(ttl), value)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  def __len__(self):
+    return len(self.entries)
@@ -0,0 +1,78 @@
+# Imports
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import threadpool
+
+class WorkerPool(object):
+  '''
+  WorkerPool runs plugin handlers off the
+  reactor thread in a bounded thread pool.
+
+  Each plugin gets its own concurrency cap
+  so a single plugin with a slow upstream
+  cannot use up every worker. The cap is
+  the plugin's max_concurrency config option
+  or the default_cap passed in.
+
+  Results are delivered back to the reactor
+  thread as Deferreds.
+  '''
+  def __init__(self, size, default_cap):
+    '''
+    Sets up a pool of at most size threads,
+    started once the reactor is running and
+    stopped when it shuts down.
+    '''
+    self.size = int(size)
+    self.default_cap = int(default_cap)
+    self.pool = threadpool.ThreadPool( minthreads=min(5, self.size)
+                                     , maxthreads=self.size
+                                     , name='ggm-workers'
+                                     )
+
+    # Dictionary of per-plugin caps where
+    #   k -> plugin object
+    #   v -> DeferredSemaphore
+    # and replaced plugins are forgotten
+    self.caps = {}
+
+    reactor.callWhenRunning(self.pool.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+
+  def cap(self, plugin):
+    '''
+    Return the DeferredSemaphore limiting
+    the concurrency of plugin.
+    '''
+    if plugin not in self.caps:
+      tokens = int(getattr(plugin, 'max_concurrency', self.default_cap))
+      tokens = max(1, min(tokens, self.size))
+      self.caps[plugin] = defer.DeferredSemaphore(tokens)
+
+    return self.caps[plugin]
+
+  def forget(self, plugin):
+    '''
+    Drop the cap of plugin once replaced,
+    e.g., a LazyPlugin by the plugin it
+    loaded. Calls of plugin in progress
+    still release it.
+    '''
+    self.caps.pop(plugin, None)
+
+  def run(self, plugin, f, *args, **kwargs):
+    '''
+    Call f(*args, **kwargs) in a worker
+    thread once plugin is below its cap.
+
+    Return a Deferred firing with the result
+    of f on the reactor thread.
+    '''
+    return self.cap(plugin).run( threads.deferToThreadPool
+                               , reactor
+                               , self.pool
+                               , f
+                               , *args
+                               , **kwargs
+                               )